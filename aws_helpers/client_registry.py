@@ -0,0 +1,44 @@
+import threading
+from botocore.config import Config
+from .get_session import get_session
+
+# Size of each client's HTTP connection pool, so concurrent requests reuse kept-alive connections
+MAX_POOL_CONNECTIONS = 50
+
+### Globals
+# Shared clients, keyed by (service name, region name, pool size, max attempts)
+clients = {}
+clients_lock = threading.Lock()
+# Incremented by reset_clients, so clients managed elsewhere (eg. async clients) know to be re-created
+generation = 0
+
+def get_client(service_name: str, region_name: str = None, max_pool_connections: int = MAX_POOL_CONNECTIONS,
+               max_attempts: int = None):
+    """
+    Return a process-wide boto3 client for the service and region, creating it on first use
+    Clients are thread-safe, so one client (and its connection pool) is shared by all threads,
+    which avoids resolving credentials and opening new TLS connections on every request
+    - service_name: eg. 'bedrock-runtime', 'lambda'
+    - region_name: AWS region of the service, uses the session's default if None
+    - max_pool_connections: max number of kept-alive connections of the client
+    - max_attempts: max attempts of each call including retries, botocore's default if None
+                    (eg. 1 when the caller retries calls itself)
+    """
+    key = (service_name, region_name, max_pool_connections, max_attempts)
+    with clients_lock:
+        if key not in clients:
+            retries = {'mode': 'standard'}
+            if max_attempts is not None:
+                retries['max_attempts'] = max_attempts
+            config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=True, retries=retries)
+            clients[key] = get_session().client(service_name, region_name=region_name, config=config)
+        return clients[key]
+
+def reset_clients():
+    """
+    Drop all shared clients, so they are re-created with fresh configuration on next use
+    """
+    global generation
+    with clients_lock:
+        clients.clear()
+        generation += 1
@@ -0,0 +1,210 @@
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import extensions
+
+log = logging.getLogger(__name__)
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of the pool in time
+    """
+    pass
+
+class ConnectionPool():
+    """
+    Thread-safe pool of psycopg2 connections, shared between the threads of a worker.
+    - Callers block (up to a timeout) when all connections are checked out
+    - Idle connections are health checked on checkout, broken ones are replaced
+    - on_connect is run once per physical connection (eg. to register pgvector)
+    - Records how long callers had to wait for a connection
+    """
+
+    def __init__(self, min_size: int = 1, max_size: int = 4, on_connect = None,
+                 health_check_interval: float = 30, **connect_kwargs):
+        """
+        Create the pool and open min_size connections
+        - min_size: number of connections to open upfront
+        - max_size: maximum number of connections checked out at once
+        - on_connect: callback taking a new connection, run once when it is opened
+        - health_check_interval: connections idle for longer than this many seconds
+                                 are pinged before being handed out
+        - connect_kwargs: arguments passed to psycopg2.connect (eg. dsn, or host/user/password...)
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool sizes min_size={min_size}, max_size={max_size}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.on_connect = on_connect
+        self.health_check_interval = health_check_interval
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = deque() # (connection, time it was returned to the pool)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._in_use = 0
+        self._closed = False
+
+        # Wait time metrics
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        """
+        Open a new physical connection and run the on_connect callback on it
+        """
+        conn = psycopg2.connect(**self.connect_kwargs)
+        try:
+            if self.on_connect:
+                self.on_connect(conn)
+                # Don't leave a transaction open from the callback
+                conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        log.info("Opened a new database connection")
+        return conn
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        """
+        Return true if the idle connection can be handed out
+        Only pings the server if the connection has been idle for a while
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            log.warning(f"Discarding unhealthy database connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout: float = None):
+        """
+        Check out a connection, waiting up to timeout seconds (or indefinitely if None)
+        for one to be available. Connections must be returned with putconn.
+        """
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+
+        start = time.monotonic()
+        acquired = self._slots.acquire(timeout=timeout) if timeout is not None else self._slots.acquire()
+        waited = time.monotonic() - start
+
+        with self._lock:
+            if not acquired:
+                self._timeouts += 1
+                raise PoolTimeout(f"Timed out after {waited:.2f}s waiting for a database connection")
+            self._checkouts += 1
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn = self._connect()
+                    break
+                conn, last_used = entry
+                if self._is_healthy(conn, last_used):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def putconn(self, conn):
+        """
+        Return a connection to the pool
+        Any open transaction is rolled back, broken connections are closed
+        """
+        try:
+            keep = not self._closed and not conn.closed
+            if keep:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    keep = False
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        keep = False
+
+            with self._lock:
+                self._in_use -= 1
+                if keep:
+                    self._idle.append((conn, time.monotonic()))
+            if not keep:
+                self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        Context manager that checks out a connection and returns it afterwards
+        Rolls back the transaction if the body raises
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        """
+        Close the idle connections, connections currently checked out
+        are closed when they are returned
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        """
+        Return the current pool size and the connection wait time metrics
+        """
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_seconds_total': self._wait_seconds_total,
+                'wait_seconds_max': self._wait_seconds_max
+            }
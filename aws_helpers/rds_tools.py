@@ -1,10 +1,19 @@
-import psycopg2
+import threading
 from .ssh_forwarder import start_ssh_forwarder
 from .param_manager import get_param_manager
+from .db_pool import ConnectionPool
 
 param_manager = get_param_manager()
 db_secret = param_manager.get_secret("credentials/RDSCredentials")
 
+# Connections are only used for short administrative queries, so the pool is kept small
+POOL_MIN_SIZE = 0
+POOL_MAX_SIZE = 2
+
+# Connection pools, keyed by dev_mode
+pools = {}
+pools_lock = threading.Lock()
+
 def execute_and_commit(sql: str, dev_mode = False):
     """
     Execute and commit the sql on the RDS db
@@ -30,36 +39,39 @@ def execute_and_fetch(sql: str, dev_mode = False):
     connect_and_callback(callback, dev_mode)
     return result
 
+def get_pool(dev_mode = False) -> ConnectionPool:
+    """
+    Return the connection pool for the RDS db, creating it on first use
+    - dev_mode: If true, connects via SSH Tunneler for local development
+                The tunnel is kept open for the lifetime of the pool
+    """
+    with pools_lock:
+        if dev_mode not in pools:
+            params = {
+                'database': db_secret["dbname"],
+                'user': db_secret["username"],
+                'password': db_secret["password"],
+                'host': db_secret["host"],
+                'port': db_secret["port"]
+            }
+            
+            if dev_mode:
+                server = start_ssh_forwarder(params["host"],params["port"])
+                params["host"] = "localhost"
+                params["port"] = server.local_bind_port
+
+            pools[dev_mode] = ConnectionPool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, **params)
+        return pools[dev_mode]
+
 def connect_and_callback(callback, dev_mode = False):
     """
-    Connect to the db, perform the callback, then close the connection
+    Check out a pooled connection to the db, perform the callback, then return the connection
     Callback fn takes the connection and cursors as parameters
     - dev_mode: If true, connects via SSH Tunneler for local development
     """
-    params = {
-        'database': db_secret["dbname"],
-        'user': db_secret["username"],
-        'password': db_secret["password"],
-        'host': db_secret["host"],
-        'port': db_secret["port"]
-    }
-    
-    server = None
-    if dev_mode:
-        server = start_ssh_forwarder(params["host"],params["port"])
-        params["host"] = "localhost"
-        params["port"] = server.local_bind_port
-        
     try: 
-        connection = psycopg2.connect(**params)
-        cursor = connection.cursor()
-        callback(connection, cursor)
+        with get_pool(dev_mode).connection() as connection:
+            with connection.cursor() as cursor:
+                callback(connection, cursor)
     except Exception as e:
-        connection.rollback()
         print(f"An error occurred: {e}")
-    finally:
-        cursor.close()
-        connection.close()
-        
-        if dev_mode and server:
-            server.close()
\ No newline at end of file
@@ -34,6 +34,36 @@ def createConnection():
 dbSecret = getDbSecret()
 connection = createConnection()
 
+LOGGING_SQL = """
+    INSERT INTO logging (question, context, retrieved_doc_ids, response) 
+    VALUES (%s, %s, %s, %s);
+"""
+FEEDBACK_SQL = """
+    INSERT INTO feedback (helpful_response, question, context, retrieved_doc_ids, response, most_relevant_doc, comment) 
+    VALUES (%s, %s, %s, %s, %s, %s,%s);
+"""
+BATCH_FAILED_STATUS = 500
+# ^ status when the whole batch was not stored (eg. the database was unavailable), the caller may retry it
+INVALID_RECORDS_STATUS = 400
+# ^ status when only invalid records were not stored, retrying would not store them
+RECORDS_KEY = 'records'
+# ^ name of the key in the event that includes a list of records,
+# each with the LOGGING_KEY and PAYLOAD_KEY, to store in one invocation
+
+def record_data(payload: str):
+    """
+    Convert the json payload of a record to the tuple of values to insert
+    """
+    data = []
+    for key, val in json.loads(payload).items():
+        if key == "feedback-hidden-helpful":
+            data.append(True if val == "yes" else False)
+        elif key == "feedback-reference-select":
+            data.append(int(val))
+        else:
+            data.append(val)
+    return tuple(data)
+
 def lambda_handler(event, context):
     
     # the connection object that were cached outside of the lambda_ha
@@ -44,41 +74,41 @@ def lambda_handler(event, context):
     
     cursor = connection.cursor()
     
-    sql = None
-    if event[LOGGING_KEY]:
-        sql = """
-            INSERT INTO logging (question, context, retrieved_doc_ids, response) 
-            VALUES (%s, %s, %s, %s);
-        """
-    else:
-        sql = """
-            INSERT INTO feedback (helpful_response, question, context, retrieved_doc_ids, response, most_relevant_doc, comment) 
-            VALUES (%s, %s, %s, %s, %s, %s,%s);
-        """
+    # Either a batch of records, or a single record
+    records = event[RECORDS_KEY] if RECORDS_KEY in event else [event]
     
-    data = []
-    for key, val in json.loads(event[PAYLOAD_KEY]).items():
-        if key == "feedback-hidden-helpful":
-            data.append(True if val == "yes" else False)
-        elif key == "feedback-reference-select":
-            data.append(int(val))
-        else:
-            data.append(val)
-    
-    print(data)
-
+    errors = []
     try:
-        cursor.execute(sql, tuple(data))
+        for index, record in enumerate(records):
+            # Use a savepoint so one invalid record does not discard the rest of the batch
+            cursor.execute("SAVEPOINT record;")
+            try:
+                data = record_data(record[PAYLOAD_KEY])
+                print(data)
+                cursor.execute(LOGGING_SQL if record[LOGGING_KEY] else FEEDBACK_SQL, data)
+                cursor.execute("RELEASE SAVEPOINT record;")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT record;")
+                errors.append(f"record {index}: {str(e)}")
         connection.commit()
-        return {
-            "statusCode": 200,
-            "msg": "Successfuly stored feedback"
-        }
     except Exception as e:
+        if not connection.closed:
+            connection.rollback()
         return {
-            "statusCode": 400,
+            "statusCode": BATCH_FAILED_STATUS,
             "msg": "Failed to store feedback",
             "body": str(e)
         }
     finally:
         cursor.close()
+
+    if errors:
+        return {
+            "statusCode": INVALID_RECORDS_STATUS,
+            "msg": f"Failed to store {len(errors)} of {len(records)} feedback records",
+            "body": "; ".join(errors)
+        }
+    return {
+        "statusCode": 200,
+        "msg": "Successfuly stored feedback"
+    }
@@ -4,6 +4,7 @@ import * as s3assets from "aws-cdk-lib/aws-s3-assets";
 import * as iam from "aws-cdk-lib/aws-iam";
 import * as path from "path";
 import * as ssm from "aws-cdk-lib/aws-ssm";
+import * as secretsmanager from "aws-cdk-lib/aws-secretsmanager";
 import { VpcStack } from "./vpc-stack";
 import { DatabaseStack } from "./database-stack";
 import * as lambda from "aws-cdk-lib/aws-lambda";
@@ -408,6 +409,19 @@ export class HostingStack extends cdk.Stack {
 
     elbEnv.node.addDependency(webAcl);
 
+    // Key signing the session cookies of the web app, shared by all of its instances
+    new secretsmanager.Secret(this, "SessionSecretKey", {
+      description: "Key signing the login session cookies of the web app",
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      secretName: "student-advising/credentials/SessionSecretKey",
+      generateSecretString: {
+        excludePunctuation: true,
+        passwordLength: 64,
+        generateStringKey: "key",
+        secretStringTemplate: JSON.stringify({}),
+      },
+    });
+
     // Create the SSM parameter with the url of the elastic beanstalk web app
     new ssm.StringParameter(this, "BeanstalkAppUrlParameter", {
       parameterName: "/student-advising/BEANSTALK_URL",
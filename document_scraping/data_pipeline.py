@@ -11,7 +11,7 @@ from scrapy.utils.project import get_project_settings
 from site_pull_spider import SitePullSpider
 from tools import write_file
 import processing_functions
-from website_dump_doc_extractor import DumpConfig, DocExtractor
+from website_dump_doc_extractor import DumpConfig, DocExtractor, COMPILED_GRAPH_DIR
 from program_options_manager import find_program_options, apply_previous_difs
 from dotenv import load_dotenv
 load_dotenv()
@@ -189,9 +189,11 @@ def main():
     pull_sites(dump_configs, output_folder = BASE_DUMP_PATH)
     process_site_dumps(doc_extractor, dump_configs, redirect_map_path=REDIRECT_FILEPATH, out_path=LOCAL_DOCUMENTS_DIR)
 
-    # Upload the website_extracts.csv and website_graph.txt
+    # Upload the website_extracts.csv, website_graph.txt and the compiled graph
     upload_file_to_s3(os.path.join(LOCAL_DOCUMENTS_DIR, "website_extracts.csv"), f"{S3_DOCUMENTS_DIR}/website_extracts.csv")
     upload_file_to_s3(os.path.join(LOCAL_DOCUMENTS_DIR, "website_graph.txt"), f"{S3_DOCUMENTS_DIR}/website_graph.txt")
+    for filename in os.listdir(os.path.join(LOCAL_DOCUMENTS_DIR, COMPILED_GRAPH_DIR)):
+        upload_file_to_s3(os.path.join(LOCAL_DOCUMENTS_DIR, COMPILED_GRAPH_DIR, filename), f"{S3_DOCUMENTS_DIR}/{COMPILED_GRAPH_DIR}/{filename}")
     
     # Find the diff between the previous iteration of faculties.json, if the files exist
     download_s3_directory(S3_DOCUMENTS_DIR, ecs_task=True)
@@ -7,7 +7,9 @@ from typing import Callable, Tuple
 from bs4 import BeautifulSoup, Tag
 import html2text
 import networkx as nx
+import numpy as np
 import pandas as pd
+import json
 import spacy
 from spacy.language import Language
 import tools
@@ -58,6 +60,8 @@ nlp.add_pipe('custom_merge', before='custom_boundaries')
 DEFAULT_MAX_LEN = 1000
 DEFAULT_ENCODING = 'utf-8-sig'
 DEFAULT_LINK_IGNORE_REGEX = r'mailto:.*'
+COMPILED_GRAPH_DIR = 'website_graph' # Output directory of the compiled graph, see compile_graph
+COMPILED_GRAPH_VERSION = 1
 
 ### DEFAULT DUMP CONFIG VALUES
 DEFAULT_TITLE_TAGS = ['h1','h2','h3','h4']
@@ -300,6 +304,7 @@ class DocExtractor:
             - parent_titles: titles of the parent webpages for the extract
             - Additional columns are added if returned from the DumpConfig.metadata_extractor
         - website_graph.txt: NetworkX graph (adjacency list format) of doc_ids, edges are links between pages
+        - website_graph/: the same graph compiled to memory-mappable arrays, see compile_graph
         """
         
         self.doc_index = DocIndex()
@@ -356,10 +361,11 @@ class DocExtractor:
             makedirs(out_path, exist_ok=True)
             df.to_csv(os.path.join(out_path,"website_extracts.csv"),encoding=self.encoding)    # save pages to csv
             nx.write_multiline_adjlist(self.graph,os.path.join(out_path,"website_graph.txt"))    # save page graph to file
+            compile_graph(self.graph,os.path.join(out_path,COMPILED_GRAPH_DIR))    # save compiled page graph for serving
 
         try:
             tools.write_file(writer)
-            log.info(' Wrote files "website_extracts.csv" and "website_graph.txt"')
+            log.info(f' Wrote files "website_extracts.csv", "website_graph.txt" and "{COMPILED_GRAPH_DIR}"')
         except:
             log.error(" Didn't save the parsed document files")
         log.info(' Document parsing complete')
@@ -765,6 +771,50 @@ def add_page_relation(G, idx_1: int, idx_2: int, relation: DocRelation):
     """
     G.add_edge(idx_1, idx_2, type=int(relation))
 
+def compile_graph(G, out_dir: str):
+    """
+    Saves the graph as arrays in compressed sparse row (CSR) format, one block per relation type and
+    direction, so the serving app can memory-map the arrays and look up the neighbours of a document
+    by relation without building a networkx graph
+    G: NetworkX graph, with the DocRelation of each edge as its 'type'
+    out_dir: directory to save the files to:
+        - node_ids.npy: sorted doc_ids of the nodes, a node's position is its row in the blocks
+        - offsets.npy: (2 * number of relations, number of nodes + 1) array, the neighbours of the node at
+                       position i in block b are targets[offsets[b, i]:offsets[b, i + 1]]
+        - targets.npy: doc_ids of the neighbours of all blocks
+        - meta.json: the format version, the relation of each block and its direction ('out' or 'in')
+    """
+    node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+    positions = {doc_id: pos for pos, doc_id in enumerate(node_ids.tolist())}
+
+    edges_by_type = {int(relation): [] for relation in DocRelation}
+    for (idx_1, idx_2, relation) in G.edges(data='type'):
+        edges_by_type[relation].append((idx_1, idx_2))
+
+    blocks = []
+    offsets = np.zeros((2 * len(edges_by_type), len(node_ids) + 1), dtype=np.int64)
+    targets = []
+    num_targets = 0
+    for relation, edges in edges_by_type.items():
+        for direction in ['out', 'in']:
+            pairs = edges if direction == 'out' else [(idx_2, idx_1) for (idx_1, idx_2) in edges]
+            sources = np.array([positions[source] for source, _ in pairs], dtype=np.int64)
+            neighbours = np.array([neighbour for _, neighbour in pairs], dtype=np.int64)
+            order = np.argsort(sources, kind='stable')
+            counts = np.bincount(sources, minlength=len(node_ids))
+            offsets[len(blocks), 1:] = np.cumsum(counts)
+            offsets[len(blocks)] += num_targets
+            targets.append(neighbours[order])
+            num_targets += len(pairs)
+            blocks.append({'relation': relation, 'direction': direction})
+
+    makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'node_ids.npy'), node_ids)
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, 'targets.npy'), np.concatenate(targets) if targets else np.zeros(0, dtype=np.int64))
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': COMPILED_GRAPH_VERSION, 'blocks': blocks}, f)
+
 def print_doc_structure(docs: list[dict], level = 0):
     """
     Function for development & debug: recursively displays the titles and 
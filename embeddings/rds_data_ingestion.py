@@ -76,7 +76,7 @@ def get_bedrock_embeddings(input_text, model_id="amazon.titan-embed-text-v2:0",
 
 ### CREATING moded.csv and moded_with_embeddings.csv
 # Select only the columns we want
-selected_columns_df = extracts_df[['doc_id', 'url', 'parent_titles', 'titles', 'text', 'links']]
+selected_columns_df = extracts_df[['doc_id', 'url', 'parent_titles', 'titles', 'text', 'links', 'faculty', 'program', 'specialization']]
 
 # Remove rows where 'text' is null
 selected_columns_df = selected_columns_df.dropna(subset=['text'])
@@ -267,7 +267,11 @@ try:
                 url text,
                 titles jsonb,
                 text text,
+                content_hash text GENERATED ALWAYS AS (md5(text)) STORED,
                 links jsonb,
+                faculty text,
+                program text,
+                specializations text[],
                 text_embedding vector({}),
                 title_embedding vector({})
                 );
@@ -350,6 +354,18 @@ try:
     data_with_embeddings['text_embedding'] = data_with_embeddings['text_embedding'].apply(ensure_list_and_pad_embedding)
     data_with_embeddings['title_embedding'] = data_with_embeddings['title_embedding'].apply(ensure_list_and_pad_embedding)
 
+    # Program metadata used to filter retrieval, empty values are stored as NULL
+    def none_if_missing(value):
+        return value if pd.notna(value) and value != '' else None
+
+    # Function to parse the list of specializations of a document
+    def parse_specializations(specializations_str):
+        try:
+            specializations = ast.literal_eval(specializations_str) if pd.notna(specializations_str) else []
+            return [specialization for specialization in specializations if specialization] or None
+        except (SyntaxError, ValueError):
+            return None
+
     # Prepare the list of tuples for insertion in batches
     batch_size = 500  # Set a smaller batch size
     total_rows = len(data_with_embeddings)
@@ -368,13 +384,16 @@ try:
                     row['titles'],
                     row['text'],
                     row['links'],
+                    none_if_missing(row['faculty']),
+                    none_if_missing(row['program']),
+                    parse_specializations(row['specialization']),
                     row['text_embedding'],
                     row['title_embedding']) for index, row in batch_data.iterrows()]
 
         logger.info(f"Inserting batch {batch + 1}/{num_batches}...")
 
         try:
-            execute_values(cur, "INSERT INTO phase_2_embeddings (doc_id, url, titles, text, links, text_embedding, title_embedding) VALUES %s", data_list)
+            execute_values(cur, "INSERT INTO phase_2_embeddings (doc_id, url, titles, text, links, faculty, program, specializations, text_embedding, title_embedding) VALUES %s", data_list)
         except Exception as e:
             logger.error(f"Error when populating table in batch {batch + 1}: {e}")
             connection.rollback()
@@ -447,7 +466,19 @@ try:
             logger.error(f"Error when indexing embeddings table: {e}")
             connection.rollback()
 
-    create_index('hnsw', 'vector_l2_ops')
+    # Retrieval ranks documents by cosine distance (<=>), so the index must use the cosine operator class
+    create_index('hnsw', 'vector_cosine_ops')
+
+    # Index the program metadata used to filter retrieval
+    try:
+        cur.execute('CREATE INDEX ON phase_2_embeddings (faculty)')
+        cur.execute('CREATE INDEX ON phase_2_embeddings (program)')
+        cur.execute('CREATE INDEX ON phase_2_embeddings USING gin (specializations)')
+        connection.commit()
+        logger.info("Created metadata indexes!")
+    except psycopg2.Error as e:
+        logger.error(f"Error when indexing metadata columns: {e}")
+        connection.rollback()
 
     ### SANITY CHECKS ON INDEX IN EMBEDDINGS TABLE
     # Perform sanity check to print all indexes on phase_2_embeddings
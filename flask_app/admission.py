@@ -0,0 +1,318 @@
+"""
+Admission control for the Bedrock model calls.
+Calls are limited by a token bucket sized to the Bedrock quota and by a max number of concurrent calls,
+with a bounded queue of the calls waiting for a token or a slot. When the queue is full, or a call would wait too long,
+Overloaded is raised so the request fails fast with a 503 instead of piling up behind the server timeout.
+Throttled calls are retried with jittered exponential backoff. The clients of the admitted calls
+should not retry themselves (eg. botocore's max_attempts set to 1), or the retries multiply.
+"""
+
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Optional
+from contextlib import contextmanager, asynccontextmanager
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# Error codes of Bedrock calls that are rejected because of the quota or load
+THROTTLING_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ModelNotReadyException')
+
+class Overloaded(Exception):
+    """
+    Raised when a call is not admitted, the request should be retried after retry_after seconds
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_throttling(error: Exception) -> bool:
+    """
+    Return True if the error is a Bedrock throttling error
+    Langchain wraps the boto3 errors, so the message is also checked for the error code
+    """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_CODES
+    return any(code in str(error) for code in THROTTLING_CODES)
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Jittered exponential backoff, a random delay up to base * 2^attempt seconds, at most cap seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket():
+    """
+    Token bucket rate limiter, refilled at rate tokens per second up to capacity tokens
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> float:
+        """
+        Reserve a token, returning the number of seconds to wait before it can be used
+        Nothing is reserved if the wait would be longer than max_wait, and Overloaded is raised
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                raise Overloaded("Rate limit of model calls exceeded", retry_after=wait)
+            # Tokens may go negative, the later callers then wait for the earlier reservations
+            self._tokens -= 1
+            return wait
+
+    def refund(self):
+        """
+        Give back a reserved token, when the call it was reserved for is not made
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+class _Waiter():
+    """
+    A call waiting for a slot, handed the slot directly by the call that releases it
+    Sync callers wait on an event, async callers on a future of their event loop
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop
+        self.granted = False
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self) -> bool:
+        """
+        Wake the waiter, return False if it can't be woken because its event loop is closed
+        """
+        if self.loop is None:
+            self.event.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+            return True
+        except RuntimeError:
+            return False
+
+    def _wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+class AdmissionController():
+    """
+    Limits the concurrency and rate of calls, with a bounded queue of waiting calls
+    Used as a context manager around each call, eg. with controller.admit(): ...
+    Sync and async callers share the same limits and the same queue, in which async callers
+    wait on their event loop instead of a thread
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, rate: float, burst: float, max_wait: float = 30,
+                 max_retries: int = 4, backoff_base: float = 0.5, backoff_cap: float = 10):
+        """
+        - max_concurrent: max number of calls in progress
+        - max_queue: max number of calls waiting for a slot, more calls are rejected
+        - rate, burst: calls per second and burst size of the token bucket, sized to the Bedrock quota
+        - max_wait: max seconds a call waits to be admitted before it is rejected
+        - max_retries: number of retries of throttled calls
+        - backoff_base, backoff_cap: seconds of the first retry backoff, and max seconds of any backoff
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.bucket = TokenBucket(rate, burst)
+        self._in_use = 0
+        self._waiters = deque()
+        self._token_waiting = 0 # Calls waiting for their token of the bucket, counted in the queue
+        self._lock = threading.Lock()
+
+    def _queued(self) -> int:
+        """
+        Number of calls waiting for a token or a slot, called with the lock held
+        """
+        return len(self._waiters) + self._token_waiting
+
+    def _reserve_token(self) -> float:
+        """
+        Reserve a token of the bucket, returning the seconds to wait before it can be used
+        A call that has to wait takes a place in the queue, and is rejected with its token refunded if the queue is full
+        """
+        wait = self.bucket.reserve(self.max_wait)
+        if wait > 0:
+            with self._lock:
+                if self._queued() >= self.max_queue:
+                    self.bucket.refund()
+                    raise Overloaded("Too many model calls waiting", retry_after=wait)
+                self._token_waiting += 1
+        return wait
+
+    def _end_token_wait(self, wait: float):
+        """
+        Leave the queue place taken by _reserve_token
+        """
+        if wait > 0:
+            with self._lock:
+                self._token_waiting -= 1
+
+    def _enqueue(self, loop: asyncio.AbstractEventLoop = None) -> Optional[_Waiter]:
+        """
+        Take a free slot, returning None, or join the queue, returning the waiter
+        Free slots are not taken while others are waiting, so waiters are admitted in order
+        """
+        with self._lock:
+            if self._in_use < self.max_concurrent and not self._waiters:
+                self._in_use += 1
+                return None
+            if self._queued() >= self.max_queue:
+                raise Overloaded("Too many model calls waiting", retry_after=self.backoff_cap)
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _dequeue(self, waiter: _Waiter) -> bool:
+        """
+        Leave the queue once done waiting, return True if the waiter was handed a slot
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def _release(self):
+        """
+        Hand the slot to the first waiter, or free it if no one is waiting
+        """
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = waiter.grant()
+                if waiter.granted:
+                    return
+            self._in_use -= 1
+
+    def _acquire_slot(self):
+        """
+        Wait for a free slot, for at most max_wait seconds
+        """
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        waiter.event.wait(self.max_wait)
+        if not self._dequeue(waiter):
+            raise Overloaded("Timed out waiting for a model call slot", retry_after=self.backoff_cap)
+
+    async def _acquire_slot_async(self):
+        """
+        Async version of _acquire_slot, waiting on the event loop
+        """
+        waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.future, self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._dequeue(waiter):
+                self._release()
+            raise
+        if not self._dequeue(waiter):
+            raise Overloaded("Timed out waiting for a model call slot", retry_after=self.backoff_cap)
+
+    @contextmanager
+    def admit(self):
+        """
+        Wait until the call is admitted, and hold its slot for the duration of the block
+        The rate limit is waited on before taking the slot, so calls waiting on it don't hold slots
+        The token is refunded if the call is then not admitted
+        """
+        wait = self._reserve_token()
+        try:
+            try:
+                time.sleep(wait)
+            finally:
+                self._end_token_wait(wait)
+            self._acquire_slot()
+        except BaseException:
+            self.bucket.refund()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def admit_async(self):
+        """
+        Async version of admit, waiting without blocking the event loop
+        """
+        wait = self._reserve_token()
+        try:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._end_token_wait(wait)
+            await self._acquire_slot_async()
+        except BaseException:
+            self.bucket.refund()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        Return the backoff before retrying a failed call, or raise if it should not be retried
+        """
+        if not is_throttling(error):
+            raise error
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+        if attempt >= self.max_retries:
+            raise Overloaded(f"Model calls are throttled: {error}", retry_after=delay) from error
+        logger.warning("Model call throttled, retrying in %.2fs", delay)
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn once admitted, retrying throttled calls with jittered exponential backoff
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.admit():
+                    return fn(*args, **kwargs)
+            except Overloaded:
+                raise
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+
+    async def call_async(self, fn, *args, **kwargs):
+        """
+        Async version of call, for a coroutine function fn
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self.admit_async():
+                    return await fn(*args, **kwargs)
+            except Overloaded:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                attempt += 1
@@ -12,18 +12,34 @@ import sys
 sys.path.append('..')
 
 # Imports
-from flask import Flask, request, render_template, Response, redirect, url_for, session
-import boto3
+from flask import Flask, request, render_template, Response, redirect, url_for, session, stream_with_context
+import re
 import json
 import os
+import math
+import uuid
+import hashlib
+import time
+import threading
+import itertools
 import numpy as np
 import ast
 from typing import List
 from importlib import reload
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, TimeoutError as FuturesTimeoutError
 from aws_helpers.rds_tools import execute_and_fetch
 from langchain_aws import BedrockLLM
-from flask_session import Session
 from aws_helpers.param_manager import get_param_manager
+from aws_helpers.client_registry import get_client, reset_clients
+from caches import AnswerCache, SemanticCache, QuestionStore, EmbeddingCache, normalize_question
+from context_packer import TokenCounter, ContextPacker
+from retrieval_policy import AdaptiveK
+from model_router import ModelRouter
+from admission import AdmissionController, Overloaded
+from sessions import configure_sessions
+from relevance_trailer import trailer_instructions, split_relevance_trailer, TrailerFilter
+import metrics
+from metrics import timed
 
 ### LOAD AWS CONFIG
 param_manager = get_param_manager()
@@ -32,28 +48,113 @@ param_manager = get_param_manager()
 VALID_USERNAME = param_manager.get_parameter("USERNAME")
 VALID_PASSWORD = param_manager.get_parameter("PASSWORD")
 MODEL_NAME = param_manager.get_parameter(['generator','MODEL_NAME'])
-SESSION_TYPE = 'filesystem'
 
 ### Constants
 FACULTIES_PATH = os.path.join('data','documents','faculties.json')
 TITLE_PATH = os.path.join('static','app_title.txt')
 DEFAULTS_PATH = os.path.join('static','defaults.json')
+SUGGESTIONS_PATH = os.path.join('static','query_suggestions.md')
 DEV_MODE = 'MODE' in os.environ and os.environ.get('MODE') == 'dev'
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", 'cookie') # 'cookie' or 'redis', see sessions.py
+# Signs the session cookies, must be shared by all containers. Read from the secret created by the hosting stack if not set
+SESSION_SECRET_KEY = os.environ.get("SESSION_SECRET_KEY")
+SESSION_SECRET_NAME = "credentials/SessionSecretKey"
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL") # Session store of the 'redis' backend
 REGION = os.environ.get("AWS_DEFAULT_REGION")
 VECTOR_DIMENSION = 1024
+EMBEDDING_MODEL = "amazon.titan-embed-text-v2:0"
+RELEVANCE_CHECK_WORKERS = 4 # Max concurrent relevance check LLM calls per worker
+RELEVANCE_CHECK_TIMEOUT = 20 # Seconds to wait for all relevance checks of a request
+# How documents are explained as relevant or not:
+# 'inline' asks for the explanations in a trailer of the generated answer, in the same LLM call,
+# falling back to separate checks of the documents the model did not explain
+# 'per_document' checks each retrieved document with a separate LLM call
+# Removed documents are only explained on demand, by the /relevance endpoint
+RELEVANCE_MODE = os.environ.get("RELEVANCE_MODE", 'inline')
+GENERATION_TOKEN_RESERVE = 1024 # Tokens of the context window left for the generated answer
+PACKING_STRATEGY = 'greedy' # How documents are selected to fit the context window, 'greedy' or 'density'
+# How many documents are retrieved per question:
+# 'adaptive' over-fetches ADAPTIVE_MAX_K documents per embedding column and keeps them until the similarity
+# falls below a floor or far below the best hit (see retrieval_policy.py)
+# 'fixed' retrieves number_of_docs documents per embedding column
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", 'adaptive')
+ADAPTIVE_MIN_K = 1 # Min number of documents kept for the prompt
+ADAPTIVE_MAX_K = 8 # Max number of documents kept for the prompt, and shown in total
+ADAPTIVE_MIN_SIMILARITY = 0.3 # Documents below this cosine similarity are not used for the prompt
+ADAPTIVE_MAX_RELATIVE_DROP = 0.25 # Documents more than this fraction less similar than the best hit are not used for the prompt
+# How the generation model is chosen per question, see model_router.py:
+# 'off' always uses MODEL_NAME, 'shadow' uses MODEL_NAME but logs the model it would have chosen,
+# 'active' answers straightforward questions with SMALL_MODEL_NAME
+MODEL_ROUTING_MODE = os.environ.get("MODEL_ROUTING_MODE", 'off')
+SMALL_MODEL_NAME = os.environ.get("SMALL_MODEL_NAME", "meta.llama3-8b-instruct-v1:0")
+ROUTING_MIN_TOP_SIMILARITY = 0.6 # Min cosine similarity of the best document for the small model
+ROUTING_MIN_SCORE_SPREAD = 0.05 # Min similarity gap between the two best documents for the small model
+ROUTING_MAX_PROMPT_TOKENS = 3000 # Max tokens of the generation prompt for the small model
+ROUTING_MAX_QUESTION_CHARS = 400 # Max characters of the question, with its program context, for the small model
+BATCH_MAX_PARALLELISM = 8 # Max number of questions of a batch request answered concurrently
+BATCH_MAX_QUESTIONS = 1000 # Max number of questions in a batch request
+# Admission control of the Bedrock calls of a worker, size the rate to the account's Bedrock quota
+MODEL_CALLS_PER_SECOND = float(os.environ.get("MODEL_CALLS_PER_SECOND", 10))
+MODEL_CALLS_BURST = 20 # Calls that can be made at once after being idle
+MAX_CONCURRENT_MODEL_CALLS = 16 # Max Bedrock calls in progress, a streamed answer only counts until its first chunk
+MAX_QUEUED_MODEL_CALLS = 32 # Max Bedrock calls waiting to be admitted, more are rejected with a 503
+MAX_MODEL_CALL_WAIT = 30 # Max seconds a Bedrock call waits to be admitted
+ANSWER_CACHE_SIZE = 256 # Max number of cached answers
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH") # If set, cached answers are persisted to this sqlite file
+QUESTION_STORE_SIZE = 1024 # Max number of recent questions whose removed documents can be explained on demand
+SEMANTIC_CACHE_SIZE = 1024 # Max number of answers cached by question embedding
+# Max cosine distance between the embeddings of two questions for them to share a cached answer
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.environ.get("SEMANTIC_CACHE_MAX_DISTANCE", 0.08))
+EMBEDDING_CACHE_SIZE = 4096 # Max number of question embeddings cached in memory
+# If set, cached embeddings are stored in this memory-mapped .npy file, shared by the workers and kept across restarts
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_DISK_SLOTS = 65536 # Number of embeddings the file holds
+EMBEDDING_WARM_QUESTIONS = 200 # Number of the most frequently logged questions embedded upon initialization
 
 ### Globals (set upon load)
 application = Flask(__name__)
 app_title = None
 faculties = {}
 last_updated_time = None
+corpus_version = None
 initialize_module = None
 store_feedback_module = None
+llms = {} # Shared LLMs, keyed by model id
+llms_lock = threading.Lock()
+admission = AdmissionController(max_concurrent=MAX_CONCURRENT_MODEL_CALLS, max_queue=MAX_QUEUED_MODEL_CALLS,
+                                rate=MODEL_CALLS_PER_SECOND, burst=MODEL_CALLS_BURST, max_wait=MAX_MODEL_CALL_WAIT)
+relevance_executor = ThreadPoolExecutor(max_workers=RELEVANCE_CHECK_WORKERS, thread_name_prefix='relevance')
+answer_cache = AnswerCache(max_size=ANSWER_CACHE_SIZE, path=ANSWER_CACHE_PATH)
+question_store = QuestionStore(max_size=QUESTION_STORE_SIZE)
+semantic_cache = SemanticCache(VECTOR_DIMENSION, max_size=SEMANTIC_CACHE_SIZE, max_distance=SEMANTIC_CACHE_MAX_DISTANCE)
+embedding_cache = EmbeddingCache(VECTOR_DIMENSION, max_size=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH,
+                                 disk_slots=EMBEDDING_CACHE_DISK_SLOTS)
+token_counter = TokenCounter(MODEL_NAME)
+token_counter.load()
+context_packer = ContextPacker(token_counter)
+retrieval_policy = AdaptiveK(min_k=ADAPTIVE_MIN_K, max_k=ADAPTIVE_MAX_K, min_similarity=ADAPTIVE_MIN_SIMILARITY,
+                             max_relative_drop=ADAPTIVE_MAX_RELATIVE_DROP)
+model_router = ModelRouter(default_model=MODEL_NAME, small_model=SMALL_MODEL_NAME, mode=MODEL_ROUTING_MODE,
+                           min_top_similarity=ROUTING_MIN_TOP_SIMILARITY, min_score_spread=ROUTING_MIN_SCORE_SPREAD,
+                           max_prompt_tokens=ROUTING_MAX_PROMPT_TOKENS, max_question_chars=ROUTING_MAX_QUESTION_CHARS)
+
+def session_secret_key():
+    """
+    Return the key signing the session cookies, from SESSION_SECRET_KEY or the Secrets Manager
+    In dev mode the secret may not exist, then None is returned and a key is generated by configure_sessions
+    """
+    if SESSION_SECRET_KEY:
+        return SESSION_SECRET_KEY
+    try:
+        return param_manager.get_secret(SESSION_SECRET_NAME)["key"]
+    except Exception:
+        if DEV_MODE:
+            return None
+        raise
 
 # Session Configuration
-application.config["SESSION_PERMANENT"] = False
-application.config["SESSION_TYPE"] = SESSION_TYPE
-Session(application)
+configure_sessions(application, backend=SESSION_BACKEND, secret_key=session_secret_key(), redis_url=SESSION_REDIS_URL,
+                   dev_mode=DEV_MODE)
 
 # Helper functions
 def read_text(filename: str, as_json = False):
@@ -63,6 +164,19 @@ def read_text(filename: str, as_json = False):
         else: result = f.read()
     return result
 
+def get_llm(model_id=MODEL_NAME):
+    """
+    Return the shared Bedrock LLM for the model, creating it on first use
+    LLMs and their clients are re-created when the app is initialized
+    """
+    with llms_lock:
+        if model_id not in llms:
+            llms[model_id] = BedrockLLM(
+                                 model_id = model_id,
+                                 client = get_client('bedrock-runtime', region_name=REGION, max_attempts=1)
+                             )
+        return llms[model_id]
+
 def log_question(question: str, context: str, answer: str, reference_ids: List[int]):
     # Save submitted question and answer
     fields = ['question','context','answer','reference_ids']
@@ -70,33 +184,33 @@ def log_question(question: str, context: str, answer: str, reference_ids: List[i
 
     payload = json.dumps(dict(zip(fields, data)))
     
-    try:
-        response = feedback_module.store_feedback(json_payload=payload, logging_only=True)
-        print(response)
-    except Exception as e:
-        # Handle any exceptions that occur during the Lambda invocation
-        print(f"ERROR occurs when submitting the feedback to the database: {e}")
+    # Stored in the background, so logging does not add latency to the request
+    with timed('logging'):
+        feedback_module.writer.submit(json_payload=payload, logging_only=True)
 
-def get_last_updated_time():
+def get_last_update():
     """
-    Get the last time documents were updated from the RDS table
-    Return as a formatted datetime
+    Get the latest row of the update_logs table, as a tuple of (id, datetime)
+    The id identifies the current version of the document corpus
     """
     sql = """
-        SELECT datetime
+        SELECT id, datetime
         FROM update_logs 
         ORDER BY id DESC 
         LIMIT 1"""
     result = execute_and_fetch(sql, dev_mode=DEV_MODE)
-    return result[0][0].strftime("%m/%d/%Y, %H:%M:%S (UTC)")
+    return result[0]
+
+def format_update_time(update_time):
+    """
+    Format the datetime of a document update for display
+    """
+    return update_time.strftime("%m/%d/%Y, %H:%M:%S (UTC)")
 
 ### METHOD TO CONVERT DATA TO EMBEDDINGS
-def get_bedrock_embeddings(input_text, model_id="amazon.titan-embed-text-v2:0", region_name=REGION):
-    # Initialize the boto3 client for Bedrock
-    bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=region_name
-    )
+def get_bedrock_embeddings(input_text, model_id=EMBEDDING_MODEL, region_name=REGION):
+    # Get the shared boto3 client for Bedrock, throttled calls are retried by the admission controller
+    bedrock = get_client('bedrock-runtime', region_name=region_name, max_attempts=1)
 
     # Prepare the prompt and request body
     body = json.dumps({
@@ -110,7 +224,7 @@ def get_bedrock_embeddings(input_text, model_id="amazon.titan-embed-text-v2:0",
     content_type = "application/json"
 
     # Invoke the Bedrock model to get embeddings
-    response = bedrock.invoke_model(
+    response = admission.call(bedrock.invoke_model,
         body=body,
         modelId=model_id,
         accept=accept,
@@ -128,122 +242,220 @@ def format_docs(docs):
     formatted_docs = "\n".join([f"Document {idx}:\n{doc['text']}" for idx, doc in enumerate(docs, 1)])
     return formatted_docs
 
+def list_column(value):
+    """
+    Read the list of a titles or links column
+    The jsonb columns are decoded by both psycopg2 and asyncpg (with the codec set in async_pipeline.configure_connection),
+    but may hold the text of a Python list, which is parsed
+    """
+    return ast.literal_eval(value) if isinstance(value, str) else value
+
+def doc_from_row(row):
+    """
+    Convert a (doc_id, url, titles, text, links, score) row into a document dict
+    Rows of psycopg2 and asyncpg give the same types
+    """
+    return {"doc_id": row[0],
+            "url": row[1],
+            "titles": list_column(row[2]),
+            "text": row[3],
+            "links": list_column(row[4]),
+            "score": row[5]}
+
+# Restricts a KNN search to the documents of the student's faculty, program and specialization,
+# and the documents that are not specific to any. A NULL filter value matches all documents
+FILTER_SQL = """
+    (%(faculty)s::text IS NULL OR faculty IS NULL OR faculty = %(faculty)s)
+    AND (%(program)s::text IS NULL OR program IS NULL OR program = %(program)s)
+    AND (%(specialization)s::text IS NULL OR specializations IS NULL OR %(specialization)s = ANY(specializations))
+"""
+FILTER_KEYS = ['faculty','program','specialization']
+
+def program_filters(program_info):
+    """
+    Metadata filters of the KNN search from the program info of the form, empty values don't filter
+    """
+    return {key: program_info.get(key) or None for key in FILTER_KEYS}
+
 # Get most similar documents from the database
-def get_docs(query_embedding, number, embedding_column):
+def get_docs(query_embedding, number, embedding_column, filters=None):
     embedding_array = np.array(query_embedding)
 
-    # Get RDS connection
-    try:
-        conn = initialize_module.return_connection()
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return []
-    
     top_docs = []
     try:
-        cur = conn.cursor()
-        # Get the top N most similar documents using the KNN <=> operator
-        cur.execute(f"""
-                        SELECT doc_id, url, titles, text, links, {embedding_column} <=> %s AS similarity
-                        FROM phase_2_embeddings
-                        ORDER BY similarity
-                        LIMIT %s
-                    """, (embedding_array, number))
-        results = cur.fetchall()
-        for result in results:
-            doc_dict = {"doc_id": result[0],
-                        "url": result[1],
-                        "titles": ast.literal_eval(result[2]),
-                        "text": result[3],
-                        "links": ast.literal_eval(result[4]),
-                        "score": result[5]}
-            top_docs.append(doc_dict)
-        cur.close()
+        with initialize_module.get_connection() as conn, conn.cursor() as cur:
+            # Get the top N most similar documents using the KNN <=> operator
+            cur.execute(f"""
+                            SELECT doc_id, url, titles, text, links, {embedding_column} <=> %(embedding)s AS similarity
+                            FROM phase_2_embeddings
+                            WHERE {FILTER_SQL}
+                            ORDER BY similarity
+                            LIMIT %(number)s
+                        """, {"embedding": embedding_array, "number": number, **program_filters(filters or {})})
+            results = cur.fetchall()
+            for result in results:
+                top_docs.append(doc_from_row(result))
     except Exception as e:
+        # The pool rolls back the connection on errors
         print(f"Error when retrieving: {e}")
-        conn.rollback()
-    finally:
-        cur.close()
     return top_docs
 
-def get_combined_docs(query_embedding, number):
-    text_docs = get_docs(query_embedding, number, embedding_column='text_embedding')
-    title_docs = get_docs(query_embedding, number, embedding_column='title_embedding')
-
-    # Combine documents, avoiding duplicates. Use doc['text'] as key since different doc IDs have been observed to have the same text
-    combined_docs = {}
-    for doc in text_docs:
-        doc_text = doc['text']
-        if doc_text not in combined_docs:
-            combined_docs[doc_text] = doc
-        else:
-            # Choose lower score if document already exists
-            combined_docs[doc_text]['score'] = min(combined_docs[doc_text]['score'], doc['score'])
+def get_doc_by_id(doc_id):
+    """
+    Get a document from the database by its doc_id, or None if it is not found
+    """
+    try:
+        with initialize_module.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                            SELECT doc_id, url, titles, text, links, NULL AS similarity
+                            FROM phase_2_embeddings
+                            WHERE doc_id = %(doc_id)s
+                            LIMIT 1
+                        """, {"doc_id": doc_id})
+            row = cur.fetchone()
+    except Exception as e:
+        # The pool rolls back the connection on errors
+        print(f"Error when retrieving document {doc_id}: {e}")
+        return None
+    return doc_from_row(row) if row else None
 
-    for doc in title_docs:
-        doc_text = doc['text']
-        if doc_text not in combined_docs:
-            combined_docs[doc_text] = doc
-        else:
-            # Choose lower score if document already exists
-            combined_docs[doc_text]['score'] = min(combined_docs[doc_text]['score'], doc['score'])
+# Runs the KNN search on both embedding columns in one statement.
+# Each search only returns row ids, content hashes and scores, the union is deduplicated
+# by content hash (different doc IDs have been observed to have the same text),
+# keeping the lowest score, and the document payload is only fetched for the fused rows
+COMBINED_DOCS_SQL = f"""
+    WITH text_knn AS (
+        SELECT id, content_hash, text_embedding <=> %(embedding)s AS similarity
+        FROM phase_2_embeddings
+        WHERE {FILTER_SQL}
+        ORDER BY similarity
+        LIMIT %(number)s
+    ), title_knn AS (
+        SELECT id, content_hash, title_embedding <=> %(embedding)s AS similarity
+        FROM phase_2_embeddings
+        WHERE {FILTER_SQL}
+        ORDER BY similarity
+        LIMIT %(number)s
+    ), fused AS (
+        SELECT DISTINCT ON (content_hash) id, similarity
+        FROM (SELECT * FROM text_knn UNION ALL SELECT * FROM title_knn) AS candidates
+        ORDER BY content_hash, similarity
+    )
+    SELECT e.doc_id, e.url, e.titles, e.text, e.links, fused.similarity
+    FROM fused
+    JOIN phase_2_embeddings e ON e.id = fused.id
+    ORDER BY fused.similarity
+    LIMIT %(number)s
+"""
 
-    # Sort documents by score in ascending order (since lower score indicates higher similarity)
-    sorted_docs = sorted(combined_docs.values(), key=lambda x: x['score'])
+def get_combined_docs(query_embedding, number, filters=None):
+    """
+    Get the most similar documents by both the text and title embeddings in one round trip
+    Returns the number most similar of the deduplicated documents, sorted by score in ascending order
+    (since lower score indicates higher similarity)
+    - filters: dict of the student's 'faculty', 'program' and 'specialization', see FILTER_SQL
+    """
+    embedding_array = np.array(query_embedding)
 
+    sorted_docs = []
+    try:
+        with initialize_module.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(COMBINED_DOCS_SQL, {"embedding": embedding_array, "number": number, **program_filters(filters or {})})
+            sorted_docs = [doc_from_row(result) for result in cur.fetchall()]
+    except Exception as e:
+        # The pool rolls back the connection on errors
+        print(f"Error when retrieving: {e}")
     return sorted_docs
 
-# Split documents based on character limit, 8,000 tokens is roughly 32,000 characters, set max characters to 25,000
-def split_docs(docs, max_chars=25000):
-    total_length = len(format_docs(docs))
-    print(total_length)
-    removed_docs = []
+def pack_docs(user_prompt, docs):
+    """
+    Split the documents into the ones that fit in the context window of the model ('docs')
+    and the ones that don't ('removed_docs'), counting tokens with the model's tokenizer
+    Also returns the number of tokens of the generation prompt with the kept documents ('prompt_tokens')
+    """
+    # Budget is what is left of the context window after the rest of the prompt and the generated answer
+    prompt_tokens = token_counter.count(generation_prompt(user_prompt, ""))
+    budget = token_counter.context_window - prompt_tokens - GENERATION_TOKEN_RESERVE
+    divided_docs = context_packer.pack(docs, budget, strategy=PACKING_STRATEGY)
+    divided_docs["prompt_tokens"] = prompt_tokens + divided_docs["tokens"]
+    return divided_docs
+
+def relevance_prompt(doc, user_prompt, model_id=MODEL_NAME):
+    """
+    Build the prompt for the model asking for a short explanation of whether the document is relevant to the question
+    """
+    system_prompt = "Provide a short explaination if the document is relevant to the question or not."
+
+    if model_id == "meta.llama3-8b-instruct-v1:0" or model_id == "meta.llama3-70b-instruct-v1:0":
+        prompt = f"""
+            <|begin_of_text|>
+            <|start_header_id|>system<|end_header_id|>
+            {system_prompt}
+            <|eot_id|>
+            <|start_header_id|>question<|end_header_id|>
+            {user_prompt}
+            <|eot_id|>
+            <|start_header_id|>document<|end_header_id|>
+            {doc['text']}
+            <|eot_id|>
+            <|start_header_id|>assistant<|end_header_id|>
+            """
+    else:
+        prompt = f"""Here is a queston that a user asked: {user_prompt}.
+            Here is the text from a document: {doc['text']}.
+            {system_prompt}
+            """
+    return prompt
 
-    while total_length > max_chars and docs:
-        removed_doc = docs.pop()
-        removed_docs.append(removed_doc)
-        total_length = len(format_docs(docs))
-    return {"docs": docs, "removed_docs": removed_docs}
+def check_document_relates(doc, user_prompt, llm):
+    """
+    Ask the LLM for a short explanation of whether the document is relevant to the question
+    """
+    with timed('relevance_check'):
+        return admission.call(llm.invoke, relevance_prompt(doc, user_prompt, llm.model_id)).strip()
 
-def check_if_documents_relates(docs, user_prompt, llm):
+def doc_with_relevance(doc, relate):
+    """
+    Return the displayed fields of a document, with the relevance explanation
+    """
+    return {"doc_id": doc['doc_id'],
+            "url": doc['url'],
+            "titles": doc['titles'],
+            "text": doc['text'],
+            "links": doc['links'],
+            "relate": relate}
 
-    system_prompt = "Provide a short explaination if the document is relevant to the question or not."
+def check_if_documents_relates(docs, user_prompt, llm, timeout=RELEVANCE_CHECK_TIMEOUT):
+    """
+    Check if each document relates to the question, running the LLM calls concurrently
+    on the shared relevance executor.
+    Checks that have not finished after timeout seconds are abandoned, and their
+    documents are returned with 'relate' set to None
+    """
+    futures = [relevance_executor.submit(check_document_relates, doc, user_prompt, llm) for doc in docs]
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        # Don't spend LLM calls on checks that have not started yet
+        future.cancel()
+    if not_done:
+        print(f"{len(not_done)} of {len(docs)} relevance checks did not finish within {timeout}s")
 
     doc_relates = []
-    for doc in docs:
-        if MODEL_NAME == "meta.llama3-8b-instruct-v1:0" or MODEL_NAME == "meta.llama3-70b-instruct-v1:0":
-            prompt = f"""
-                <|begin_of_text|>
-                <|start_header_id|>system<|end_header_id|>
-                {system_prompt}
-                <|eot_id|>
-                <|start_header_id|>question<|end_header_id|>
-                {user_prompt}
-                <|eot_id|>
-                <|start_header_id|>document<|end_header_id|>
-                {doc['text']}
-                <|eot_id|>
-                <|start_header_id|>assistant<|end_header_id|>
-                """
-        else:
-            prompt = f"""Here is a queston that a user asked: {user_prompt}.
-                Here is the text from a document: {doc['text']}.
-                {system_prompt}
-                """
-        response = llm.invoke(prompt).strip()
-
-        doc_info = {"doc_id": doc['doc_id'],
-                    "url": doc['url'],
-                    "titles": doc['titles'],
-                    "text": doc['text'],
-                    "links": doc['links'],
-                    "relate": response}
-        doc_relates.append(doc_info)
+    for doc, future in zip(docs, futures):
+        response = None
+        if future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"Error when checking document relevance: {e}")
+        doc_relates.append(doc_with_relevance(doc, response))
 
     return doc_relates
 
-def answer_prompt(user_prompt, number_of_docs):
-
+def validate_answer_input(user_prompt, number_of_docs):
+    """
+    Raise a ValueError if the arguments to answer_prompt are invalid
+    """
     # Validate user_input
     if not isinstance(user_prompt, str):
         raise ValueError("user_input must be a string")
@@ -255,24 +467,130 @@ def answer_prompt(user_prompt, number_of_docs):
         raise ValueError("number_of_docs must be an integer")
     if number_of_docs < 1:
         raise ValueError("number_of_docs must be greater than 0")
-        
-    # Convert user's prompt to embedding
-    embedding = get_bedrock_embeddings(user_prompt)
 
-    docs = get_combined_docs(embedding, number_of_docs)
+def embedding_cache_key(text, model_id=EMBEDDING_MODEL):
+    """
+    Build the embedding cache key of a text
+    """
+    return EmbeddingCache.make_key(text, model_id, VECTOR_DIMENSION)
 
-    divided_docs = split_docs(docs)
+def cached_embedding(key):
+    """
+    Return the cached embedding for the key, or None, counting the lookup
+    """
+    embedding = embedding_cache.get(key)
+    metrics.cache_lookups.inc(cache='embedding', result='miss' if embedding is None else 'hit')
+    return embedding
 
-    documents = format_docs(divided_docs["docs"])
+def embed_question(user_prompt):
+    """
+    Convert the user's prompt to an embedding, reusing the embedding of a previous identical question
+    """
+    with timed('embedding'):
+        key = embedding_cache_key(user_prompt)
+        embedding = cached_embedding(key)
+        if embedding is None:
+            embedding = get_bedrock_embeddings(user_prompt)
+            if embedding:
+                embedding_cache.put(key, embedding)
+        return embedding
 
-    # Get the LLM we want to invoke
-    llm = BedrockLLM(
-                        model_id = MODEL_NAME
-                    )
+def warm_questions(limit):
+    """
+    Questions to embed upon initialization: the example questions quoted in the query suggestions,
+    and the most frequently logged questions.
+    Only questions logged without a context are used, since the embedded question of a logged question with a
+    context (see format_question) can't be rebuilt from the joined context string.
+    """
+    questions = re.findall(r'"([^"]+\?)"', read_text(SUGGESTIONS_PATH))
+    sql = f"""
+        SELECT question
+        FROM logging
+        WHERE context IS NULL OR context = ''
+        GROUP BY question
+        ORDER BY COUNT(*) DESC
+        LIMIT {int(limit)}"""
+    try:
+        questions += [row[0] for row in execute_and_fetch(sql, dev_mode=DEV_MODE)]
+    except Exception as e:
+        print(f"Error reading the logged questions to warm the embedding cache: {e}")
+    return questions
+
+def warm_embedding_cache(limit=EMBEDDING_WARM_QUESTIONS):
+    """
+    Embed the frequent questions that are not cached yet, so repeats of them skip the Bedrock call
+    With a persisted cache, questions embedded before a restart are not embedded again
+    """
+    warmed = 0
+    for question in warm_questions(limit):
+        key = embedding_cache_key(question)
+        if key in embedding_cache:
+            continue
+        try:
+            embedding = get_bedrock_embeddings(question)
+        except Exception as e:
+            # Stop rather than compete with requests for the Bedrock quota
+            print(f"Stopped warming the embedding cache: {e}")
+            break
+        if embedding:
+            embedding_cache.put(key, embedding)
+            warmed += 1
+    print(f"Warmed the embedding cache with {warmed} questions")
 
+def retrieve_docs(user_prompt, number_of_docs, embedding, filters=None):
+    """
+    Retrieve the documents for the question, split into the documents
+    that fit in the prompt ('docs') and the ones that don't ('removed_docs')
+    - embedding: the embedding of the user's prompt, from embed_question
+    - filters: the student's program info, to only retrieve documents that apply to it
+    """
+    with timed('knn_query'):
+        docs = get_combined_docs(embedding, knn_fetch_count(number_of_docs), filters)
+
+    return select_docs(user_prompt, docs)
+
+def knn_fetch_count(number_of_docs):
+    """
+    Number of documents to fetch per embedding column, for the retrieval mode
+    """
+    return retrieval_policy.max_k if RETRIEVAL_MODE == 'adaptive' else number_of_docs
+
+def select_docs(user_prompt, docs):
+    """
+    Choose the retrieved documents to use in the prompt ('docs') and to only show ('removed_docs')
+    - docs: the retrieved documents, sorted by score
+    """
+    cut_docs = []
+    if RETRIEVAL_MODE == 'adaptive':
+        # Scores are cosine distances
+        docs, cut_docs = retrieval_policy.split(docs, [1 - doc['score'] for doc in docs])
+
+    with timed('packing'):
+        divided_docs = pack_docs(user_prompt, docs)
+
+    if cut_docs:
+        # Documents below the cutoff are still shown as additional references, up to the max number of documents
+        shown = max(0, retrieval_policy.max_k - len(divided_docs["docs"]))
+        divided_docs["removed_docs"] = (divided_docs["removed_docs"] + cut_docs)[:shown]
+    return divided_docs
+
+def route_question(user_prompt, divided_docs):
+    """
+    Choose the generation model of the question, from its retrieved documents (see model_router.py)
+    - divided_docs: the documents of the question, from retrieve_docs
+    """
+    return model_router.route(user_prompt, divided_docs["docs"], divided_docs["prompt_tokens"])
+
+def generation_prompt(user_prompt, documents, model_id=MODEL_NAME):
+    """
+    Build the answer generation prompt for the model
+    - documents: the formatted documents, from format_docs
+    """
     system_prompt = "You are a helpful UBC student advising assistant who answers with kindness while being concise."
+    if RELEVANCE_MODE == 'inline':
+        system_prompt += " " + trailer_instructions()
 
-    if MODEL_NAME == "meta.llama3-8b-instruct-v1:0" or MODEL_NAME == "meta.llama3-70b-instruct-v1:0":
+    if model_id == "meta.llama3-8b-instruct-v1:0" or model_id == "meta.llama3-70b-instruct-v1:0":
         prompt = f"""
             <|begin_of_text|>
             <|start_header_id|>system<|end_header_id|>
@@ -291,13 +609,312 @@ def answer_prompt(user_prompt, number_of_docs):
             Here is the question: {user_prompt}.
             Here are the source documents: {documents}
             """
+    return prompt
 
-    answer = llm.invoke(prompt)
+def semantic_cache_partition(context_key, number_of_docs):
+    """
+    Partition of the semantic cache for the question, cached answers are only reused
+    for the same program context, model routing, document corpus and number of documents
+    """
+    return SemanticCache.make_partition(context_key, MODEL_NAME, model_router.policy_key(), corpus_version, number_of_docs)
+
+def semantic_cache_embedding(question, user_prompt, embedding):
+    """
+    Embedding of the question in the semantic cache: the student's bare question, since the program context
+    prepended by format_question is shared by all questions of a program and would inflate their similarity.
+    The context is part of the partition instead. Reuses the embedding of user_prompt if there is no bare question
+    """
+    if not question or question == user_prompt:
+        return embedding
+    return embed_question(question)
+
+def semantic_cache_get(embedding, partition):
+    """
+    Look up the answer of a similar question in the semantic cache, counting hits and misses
+    """
+    response = semantic_cache.get(embedding, partition)
+    metrics.cache_lookups.inc(cache='semantic', result='miss' if response is None else 'hit')
+    return response
+
+def inline_relevance(output, docs, user_prompt, llm):
+    """
+    Split the generated output into the answer and the relevance explanations of its trailer
+    Documents the model did not explain are checked separately, as in check_if_documents_relates
+    Returns the answer, and the documents with their relevance explanation
+    """
+    answer, judgments = split_relevance_trailer(output)
+
+    missing = [doc for number, doc in enumerate(docs, 1) if number not in judgments]
+    if missing:
+        print(f"{len(missing)} of {len(docs)} documents were not explained in the answer, checking them separately")
+    checked_missing = iter(check_if_documents_relates(missing, user_prompt, llm))
+
+    return answer, [doc_with_relevance(doc, judgments[number]) if number in judgments else next(checked_missing)
+                    for number, doc in enumerate(docs, 1)]
+
+def answer_prompt(user_prompt, number_of_docs, context_key='', filters=None, question=None):
+    """
+    Answer the question with the retrieved documents, and check if each document relates to the question
+    - context_key: the program context of the question, answers of similar questions are only
+                   reused from the semantic cache within the same context
+    - filters: the student's program info, to only retrieve documents that apply to it
+    - question: the student's question without the program context, matched in the semantic cache
+    """
+    validate_answer_input(user_prompt, number_of_docs)
+
+    embedding = embed_question(user_prompt)
+
+    # A similar enough question may already have been answered
+    partition = semantic_cache_partition(context_key, number_of_docs)
+    question_embedding = semantic_cache_embedding(question, user_prompt, embedding)
+    cached = semantic_cache_get(question_embedding, partition)
+    if cached is not None:
+        return cached
+
+    divided_docs = retrieve_docs(user_prompt, number_of_docs, embedding, filters)
 
-    check_docs = check_if_documents_relates(divided_docs["docs"], user_prompt, llm)
-    check_removed_docs = check_if_documents_relates(divided_docs["removed_docs"], user_prompt, llm)
+    documents = format_docs(divided_docs["docs"])
+
+    # Get the LLM we want to invoke
+    model_id = route_question(user_prompt, divided_docs)
+    llm = get_llm(model_id)
+
+    with timed('generation'):
+        output = admission.call(llm.invoke, generation_prompt(user_prompt, documents, model_id))
+
+    if RELEVANCE_MODE == 'inline':
+        answer, check_docs = inline_relevance(output, divided_docs["docs"], user_prompt, llm)
+    else:
+        answer = output
+        check_docs = check_if_documents_relates(divided_docs["docs"], user_prompt, llm)
+
+    # The removed documents are explained on demand, when the user expands them
+    check_removed_docs = [doc_with_relevance(doc, None) for doc in divided_docs["removed_docs"]]
+
+    response = {"answer": answer, "docs": check_docs, "removed_docs": check_removed_docs}
+    if is_cacheable(response):
+        semantic_cache.put(question_embedding, partition, response)
+    return response
+
+def is_cacheable(response):
+    """
+    Whether a response can be cached: it has an answer, and no relevance check of its documents timed out
+    Removed documents are always explained on demand, so their relevance is not checked
+    """
+    return bool(response["answer"]) and all(doc["relate"] is not None for doc in response["docs"])
+
+def remember_question(user_prompt, response):
+    """
+    Keep the removed documents of a response, so the /relevance endpoint can explain them on demand
+    Returns a copy of the response with a 'question_id', the response itself may be cached and is not changed
+    """
+    response = dict(response, question_id=response.get("question_id") or uuid.uuid4().hex)
+    question_store.put(response["question_id"], user_prompt, response["removed_docs"])
+    return response
+
+def answer_cache_key(user_prompt, number_of_docs):
+    """
+    Key of the answer cache entry for the question
+    """
+    return AnswerCache.make_key(user_prompt, MODEL_NAME, corpus_version, number_of_docs, model_router.policy_key())
 
-    return {"answer": answer, "docs": check_docs, "removed_docs": check_removed_docs}
+def cached_answer_prompt(user_prompt, number_of_docs, context_key='', filters=None, question=None):
+    """
+    answer_prompt, returning the cached response if the same question was already answered
+    with the current model and document corpus
+    """
+    key = answer_cache_key(user_prompt, number_of_docs)
+    response = answer_cache.get(key)
+    metrics.cache_lookups.inc(cache='answer', result='miss' if response is None else 'hit')
+    if response is None:
+        # The question id is cached with the response, so its removed documents can still be explained on replays
+        response = remember_question(user_prompt, answer_prompt(user_prompt, number_of_docs, context_key, filters, question))
+        if is_cacheable(response):
+            answer_cache.put(key, response)
+    else:
+        response = remember_question(user_prompt, response)
+    return response
+
+def replay_response(user_prompt, response):
+    """
+    Yield the events of stream_answer_prompt for a cached response
+    """
+    response = remember_question(user_prompt, response)
+    yield 'references', {"question_id": response["question_id"], "docs": response["docs"], "removed_docs": response["removed_docs"]}
+    yield 'token', {"text": response["answer"]}
+    yield 'done', {"answer": response["answer"]}
+
+def open_stream(llm, prompt):
+    """
+    Start streaming the LLM's response, returning an iterator of its chunks
+    Waits for the first chunk, so the call is admitted and its throttling retried like an invoke.
+    The rest is read at the pace of the client without holding an admission slot, and errors while
+    reading it are not retried, since the chunks already sent can't be taken back
+    """
+    chunks = iter(llm.stream(prompt))
+    first = next(chunks, None)
+    return chunks if first is None else itertools.chain([first], chunks)
+
+def stream_answer_prompt(user_prompt, number_of_docs, context_key='', filters=None, question=None):
+    """
+    Streaming version of answer_prompt, yields (event, data) tuples as each part of the response is ready:
+    - ('references', {'question_id': ..., 'docs': [...], 'removed_docs': [...]}) once the documents are retrieved
+    - ('token', {'text': ...}) for each chunk of the answer, as the LLM generates it
+      (in the 'inline' relevance mode, the relevance trailer is not streamed)
+    - ('relevance', doc) for each document once its relevance explanation is ready
+    - ('done', {'answer': ...}) with the full answer at the end
+    """
+    validate_answer_input(user_prompt, number_of_docs)
+
+    key = answer_cache_key(user_prompt, number_of_docs)
+    cached = answer_cache.get(key)
+    metrics.cache_lookups.inc(cache='answer', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        yield from replay_response(user_prompt, cached)
+        return
+
+    embedding = embed_question(user_prompt)
+    partition = semantic_cache_partition(context_key, number_of_docs)
+    question_embedding = semantic_cache_embedding(question, user_prompt, embedding)
+    cached = semantic_cache_get(question_embedding, partition)
+    if cached is not None:
+        yield from replay_response(user_prompt, cached)
+        return
+
+    divided_docs = retrieve_docs(user_prompt, number_of_docs, embedding, filters)
+    all_docs = divided_docs["docs"] + divided_docs["removed_docs"]
+
+    references = remember_question(user_prompt, {
+        "docs": [doc_with_relevance(doc, None) for doc in divided_docs["docs"]],
+        "removed_docs": [doc_with_relevance(doc, None) for doc in divided_docs["removed_docs"]]})
+    yield 'references', references
+
+    # Get the LLM we want to invoke
+    model_id = route_question(user_prompt, divided_docs)
+    llm = get_llm(model_id)
+    inline = RELEVANCE_MODE == 'inline'
+
+    # The relevance checks don't depend on the answer, so they run while the answer is streamed
+    deadline = time.monotonic() + RELEVANCE_CHECK_TIMEOUT
+    futures = {} # relevance check future -> position of the document in all_docs
+    if not inline:
+        # The removed documents are explained on demand, when the user expands them
+        futures = {relevance_executor.submit(check_document_relates, doc, user_prompt, llm): idx for idx, doc in enumerate(divided_docs["docs"])}
+
+    chunks = []
+    trailer_filter = TrailerFilter()
+    generation_start = time.perf_counter()
+    stream = admission.call(open_stream, llm, generation_prompt(user_prompt, format_docs(divided_docs["docs"]), model_id))
+    for chunk in stream:
+        chunks.append(chunk)
+        text = trailer_filter.feed(chunk) if inline else chunk
+        if text:
+            yield 'token', {"text": text}
+    if inline and trailer_filter.remainder():
+        yield 'token', {"text": trailer_filter.remainder()}
+    metrics.stage_seconds.observe(time.perf_counter() - generation_start, stage='generation')
+
+    relates = {} # position of the document in all_docs -> relevance explanation
+    if inline:
+        answer, judgments = trailer_filter.finish()
+        for number, doc in enumerate(divided_docs["docs"], 1):
+            if number in judgments:
+                relates[number - 1] = judgments[number]
+                yield 'relevance', doc_with_relevance(doc, judgments[number])
+        # Fall back to checking the documents the model did not explain
+        deadline = time.monotonic() + RELEVANCE_CHECK_TIMEOUT
+        futures = {relevance_executor.submit(check_document_relates, doc, user_prompt, llm): idx
+                   for idx, doc in enumerate(divided_docs["docs"]) if idx not in relates}
+    else:
+        answer = "".join(chunks)
+
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+            try:
+                relates[futures[future]] = future.result()
+                yield 'relevance', doc_with_relevance(all_docs[futures[future]], relates[futures[future]])
+            except Exception as e:
+                print(f"Error when checking document relevance: {e}")
+    except FuturesTimeoutError:
+        unfinished = [future for future in futures if not future.done()]
+        for future in unfinished:
+            future.cancel()
+        print(f"{len(unfinished)} of {len(futures)} relevance checks did not finish within {RELEVANCE_CHECK_TIMEOUT}s")
+
+    if answer:
+        checked = [doc_with_relevance(doc, relates.get(idx)) for idx, doc in enumerate(all_docs)]
+        response = {"question_id": references["question_id"],
+                    "answer": answer,
+                    "docs": checked[:len(divided_docs["docs"])],
+                    "removed_docs": checked[len(divided_docs["docs"]):]}
+        if is_cacheable(response):
+            answer_cache.put(key, response)
+            semantic_cache.put(question_embedding, partition, response)
+
+    yield 'done', {"answer": answer}
+
+def read_question_form(form):
+    """
+    Read the topic, question and program info submitted from the form template
+    """
+    topic = form['topic']
+    question = form['question']
+    filter_elems = ['faculty','program','specialization','year']
+    program_info = {filter_elem: form[filter_elem] for filter_elem in filter_elems}
+    return topic, question, program_info
+
+def format_question(program_info, topic, question):
+    """
+    Prepend the program info and topic to the question, as input for answer_prompt
+    """
+    formatted_question = ""
+    if program_info['faculty']:
+        formatted_question += f"I am in {program_info['faculty']}. "
+    
+    if program_info['program']:
+        formatted_question += f"I am in the {program_info['program']} program. "
+    
+    if program_info['specialization']:
+        formatted_question += f"I am in the {program_info['specialization']} specialization. "
+    
+    if program_info['year']:
+        formatted_question += f"I am in my {program_info['year']}. "
+    
+    if topic:
+        formatted_question += f"The topic of the question is {topic}. "
+    
+    formatted_question += question
+    return formatted_question
+
+def context_string(program_info, topic):
+    """
+    Join the non-empty program info values and topic, for display and logging
+    """
+    return ' : '.join([value for value in list(program_info.values()) + [topic] if len(value) > 0])
+
+def render_answer(question, context_str, response, form, user_prompt, streaming=False):
+    """
+    Render the answer page for a response of answer_prompt
+    - form: the submitted form fields, so they can be filled in again
+    - user_prompt: the question as answered, sent back with /relevance requests
+    - streaming: render the page without the response, and stream it into the page from /answer/stream
+    """
+    with timed('render'):
+        return render_template('ans.html',title=app_title,question=question,context=context_str,docs=response["docs"],
+                               form=form, main_response=response["answer"], question_id=response.get("question_id"),
+                               user_prompt=user_prompt, streaming=streaming,
+                               removed_docs=response["removed_docs"], last_updated=last_updated_time)
+
+def submit_feedback(form):
+    """
+    Submit the feedback form fields to be stored in the background by the feedback writer
+    """
+    fields = ['feedback-hidden-helpful','feedback-hidden-question','feedback-hidden-context',
+              'feedback-hidden-reference-ids','feedback-hidden-response','feedback-reference-select','feedback-comments']
+    data = [form[field] for field in fields]
+
+    payload = json.dumps(dict(zip(fields, data)))
+    feedback_module.writer.submit(json_payload=payload)
         
 # Authentication decorator
 def login_required(f):
@@ -308,6 +925,21 @@ def login_required(f):
     wrap.__name__ = f.__name__
     return wrap
 
+def retry_after_seconds(error: Overloaded) -> int:
+    """
+    Whole seconds to wait before retrying a request that was rejected by admission control
+    """
+    return max(1, math.ceil(error.retry_after))
+
+@application.errorhandler(Overloaded)
+def overloaded(error):
+    """
+    Fail fast when model calls are not admitted, so clients can retry later instead of waiting on a timeout
+    """
+    print(f"Rejected request: {error}")
+    return Response("The service is busy, please try again shortly", status=503,
+                    headers={'Retry-After': str(retry_after_seconds(error))})
+
 @application.route('/login', methods=['GET', 'POST'])
 def login():
     error = None
@@ -342,61 +974,190 @@ async def answer():
         # App is not yet initialized
         return render_template('not_initialized.html',title=app_title)
     
-    # Submission from the form template
-    topic = request.form['topic']
-    question = request.form['question']
-    filter_elems = ['faculty','program','specialization','year']
-    program_info = {filter_elem: request.form[filter_elem] for filter_elem in filter_elems}
-    
-    formatted_question = ""
-    if program_info['faculty']:
-        formatted_question += f"I am in {program_info['faculty']}. "
-    
-    if program_info['program']:
-        formatted_question += f"I am in the {program_info['program']} program. "
-    
-    if program_info['specialization']:
-        formatted_question += f"I am in the {program_info['specialization']} specialization. "
-    
-    if program_info['year']:
-        formatted_question += f"I am in my {program_info['year']}. "
-    
-    if topic:
-        formatted_question += f"The topic of the question is {topic}. "
-    
-    formatted_question += question
+    with metrics.requests_in_flight.track(endpoint='/answer'), metrics.request_seconds.time(endpoint='/answer'):
+        # Submission from the form template
+        topic, question, program_info = read_question_form(request.form)
+        formatted_question = format_question(program_info, topic, question)
+        context_str = context_string(program_info, topic)
+
+        response = cached_answer_prompt(formatted_question, 3, context_str, program_info, question)
 
-    response = answer_prompt(formatted_question, 3)
+        # Log the question
+        log_question(question, context_str, response["answer"], [doc['doc_id'] for doc in response["docs"]])
+        
+        # Render the results
+        return render_answer(question, context_str, response, request.form.to_dict(), formatted_question)
+
+@application.route('/answer/page', methods=['POST'])
+def answer_page():
+    """
+    Render the answer page right away, without the answer
+    The page streams the answer and references from /answer/stream, so the answer is shown as it is generated
+    """
+    if not initialize_module:
+        # App is not yet initialized
+        return render_template('not_initialized.html',title=app_title)
+
+    topic, question, program_info = read_question_form(request.form)
+    formatted_question = format_question(program_info, topic, question)
+    context_str = context_string(program_info, topic)
+    response = {"answer": "", "docs": [], "removed_docs": []}
+    return render_answer(question, context_str, response, request.form.to_dict(), formatted_question, streaming=True)
+
+@application.route('/answer/stream', methods=['POST'])
+def answer_stream():
+    """
+    Streaming variant of /answer, takes the same form fields and responds with server-sent events:
+    the retrieved references first, then the answer tokens as they are generated,
+    then the relevance explanations as they finish (see stream_answer_prompt)
+    With the 'render=html' query parameter, the references event also has the 'html' of the references,
+    as rendered on the answer page
+    """
+    if not initialize_module:
+        # App is not yet initialized
+        return render_template('not_initialized.html',title=app_title)
 
-    # Get the answer returned by the LLM
-    main_response = response["answer"]
-    # Get the documents used to help generate the answer
-    docs = response["docs"]
+    topic, question, program_info = read_question_form(request.form)
+    formatted_question = format_question(program_info, topic, question)
+    context_str = context_string(program_info, topic)
+    render_html = request.args.get('render') == 'html'
 
-    # Log the question
-    context_str = ' : '.join([value for value in list(program_info.values()) + [topic] if len(value) > 0])
-    log_question(question, context_str, main_response, [doc['doc_id'] for doc in docs])
+    def generate():
+        main_response = None
+        reference_ids = []
+        with metrics.requests_in_flight.track(endpoint='/answer/stream'), metrics.request_seconds.time(endpoint='/answer/stream'):
+            try:
+                for event, data in stream_answer_prompt(formatted_question, 3, context_str, program_info, question):
+                    if event == 'references':
+                        reference_ids = [doc['doc_id'] for doc in data['docs']]
+                        if render_html:
+                            data = dict(data, html=render_template('references.html', docs=data['docs'],
+                                                                   removed_docs=data['removed_docs']))
+                    elif event == 'done':
+                        main_response = data['answer']
+                    yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            except Overloaded as e:
+                print(f"Overloaded when streaming the answer: {e}")
+                yield f"event: error\ndata: {json.dumps({'message': 'The service is busy, please try again shortly', 'retry_after': retry_after_seconds(e)})}\n\n"
+                return
+            except Exception as e:
+                print(f"Error when streaming the answer: {e}")
+                yield f"event: error\ndata: {json.dumps({'message': 'Could not generate an answer'})}\n\n"
+                return
+
+            # Log the question
+            log_question(question, context_str, main_response, reference_ids)
+
+    # Disable caching and proxy buffering so events are flushed to the client immediately
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+def question_hash_id(user_prompt):
+    """
+    Question id of a question sent with a /relevance request, from the hash of the normalized question
+    """
+    return 'question-' + hashlib.sha256(normalize_question(user_prompt).encode('utf-8')).hexdigest()
+
+@application.route('/relevance/<question_id>/<doc_id>', methods=['GET'])
+@login_required
+def relevance(question_id, doc_id):
+    """
+    Explain if a removed document of an answered question is relevant to it
+    Called when the user expands the document, the explanation is kept for later requests
+    The question store is per process, so if the question was answered by another worker,
+    the explanation is computed from the 'question' query parameter and the document in the database,
+    and kept by the hash of the question
+    """
+    stored = question_store.get_doc(question_id, doc_id)
+    if stored is None:
+        user_prompt = request.args.get('question', '')
+        if not user_prompt:
+            return Response(json.dumps({"error": "Unknown question or document"}), status=404, mimetype='application/json')
+        question_id = question_hash_id(user_prompt)
+        stored = question_store.get_doc(question_id, doc_id)
+    if stored is None:
+        doc = get_doc_by_id(doc_id)
+        if doc is None:
+            return Response(json.dumps({"error": "Unknown question or document"}), status=404, mimetype='application/json')
+        question_store.put(question_id, user_prompt, [doc_with_relevance(doc, None)])
+        stored = user_prompt, doc
+
+    user_prompt, doc = stored
+    relate = doc.get("relate")
+    if relate is None:
+        relate = check_document_relates(doc, user_prompt, get_llm(MODEL_NAME))
+        question_store.set_relate(question_id, doc_id, relate)
+
+    return Response(json.dumps({"doc_id": doc["doc_id"], "relate": relate}), mimetype='application/json')
+
+def answer_batch_question(entry, number_of_docs):
+    """
+    Answer one question of a batch request, returning the result as a json serializable dict
+    - entry: dict with the 'question', and optionally the 'topic' and program info fields of the form
+    """
+    topic = entry.get('topic', '')
+    question = entry['question']
+    program_info = {filter_elem: entry.get(filter_elem, '') for filter_elem in ['faculty','program','specialization','year']}
+    context_str = context_string(program_info, topic)
+    response = cached_answer_prompt(format_question(program_info, topic, question), number_of_docs, context_str, program_info,
+                                    question)
+    return {"question": question,
+            "context": context_str,
+            "answer": response["answer"],
+            "docs": response["docs"],
+            "removed_docs": response["removed_docs"]}
+
+@application.route('/answer/batch', methods=['POST'])
+@login_required
+def answer_batch():
+    """
+    Answer many questions for offline workloads such as evaluation
+    Takes a json body:
+        - questions: list of dicts with the 'question', and optionally the 'topic', 'faculty',
+                     'program', 'specialization' and 'year' fields of the form
+        - parallelism: optional number of questions to answer concurrently, up to BATCH_MAX_PARALLELISM
+        - number_of_docs: optional number of documents to retrieve per question
+    Responds with one json line per question as soon as it is answered, in completion order.
+    Each line has the 'index' of the question in the request, and either the answer or an 'error'.
+    Batch questions are not logged to the question logging table.
+    """
+    if not initialize_module:
+        return Response(json.dumps({"error": "The app is not initialized"}), status=503, mimetype='application/json')
+
+    body = request.get_json(silent=True) or {}
+    questions = body.get('questions')
+    parallelism = body.get('parallelism', BATCH_MAX_PARALLELISM)
+    number_of_docs = body.get('number_of_docs', 3)
+    if not isinstance(questions, list) or not all(isinstance(entry, dict) and entry.get('question') for entry in questions):
+        return Response(json.dumps({"error": "'questions' must be a list of objects with a 'question'"}), status=400, mimetype='application/json')
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return Response(json.dumps({"error": f"At most {BATCH_MAX_QUESTIONS} questions can be answered per request"}), status=400, mimetype='application/json')
+    if not isinstance(parallelism, int) or parallelism < 1:
+        return Response(json.dumps({"error": "'parallelism' must be a positive integer"}), status=400, mimetype='application/json')
     
-    # Render the results
-    return render_template('ans.html',title=app_title,question=question,context=context_str,docs=docs,
-                           form=request.form.to_dict(), main_response=main_response,
-                           removed_docs=response["removed_docs"], last_updated=last_updated_time)
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=min(parallelism, BATCH_MAX_PARALLELISM), thread_name_prefix='batch')
+        with metrics.requests_in_flight.track(endpoint='/answer/batch'), metrics.request_seconds.time(endpoint='/answer/batch'):
+            try:
+                futures = {executor.submit(answer_batch_question, entry, number_of_docs): index for index, entry in enumerate(questions)}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        result = {"index": index, **future.result()}
+                    except Exception as e:
+                        print(f"Error when answering batch question {index}: {e}")
+                        result = {"index": index, "question": questions[index]['question'], "error": str(e)}
+                    yield json.dumps(result) + "\n"
+            finally:
+                # Stop answering if the client disconnected
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @application.route('/feedback', methods=['POST'])
 async def feedback():
     # Save submitted feedback
-    fields = ['feedback-hidden-helpful','feedback-hidden-question','feedback-hidden-context',
-              'feedback-hidden-reference-ids','feedback-hidden-response','feedback-reference-select','feedback-comments']
-    data = [request.form[field] for field in fields]
-
-    payload = json.dumps(dict(zip(fields, data)))
-
-    try:
-        response = feedback_module.store_feedback(json_payload=payload)
-        print(response)
-    except Exception as e:
-        # Handle any exceptions that occur during the Lambda invocation
-        print(f"ERROR occurs when submitting the feedback to the database: {e}")
+    submit_feedback(request.form)
             
     # Render the results
     return render_template('feedback.html',title=app_title)
@@ -410,6 +1171,11 @@ def initialize():
     """
     global initialize_module, feedback_module
     
+    # Re-create the AWS clients and LLMs with the reloaded configuration
+    reset_clients()
+    with llms_lock:
+        llms.clear()
+
     if not initialize_module:
         import initialize as initialize_module
         import feedback as feedback_module
@@ -418,9 +1184,18 @@ def initialize():
         reload(feedback_module)
     
     # Upon loading, load the available settings for the form
-    global faculties, last_updated_time
+    global faculties, last_updated_time, corpus_version
     faculties = read_text(FACULTIES_PATH,as_json=True)
-    last_updated_time = get_last_updated_time()
+    update_id, update_time = get_last_update()
+    last_updated_time = format_update_time(update_time)
+    corpus_version = update_id
+
+    # Cached answers may refer to documents from before a re-ingestion
+    answer_cache.clear()
+    semantic_cache.clear()
+
+    # Embeddings of questions don't depend on the documents, so the embedding cache is kept and only warmed
+    threading.Thread(target=warm_embedding_cache, name='embedding-warmup', daemon=True).start()
     
     return "Successfully initialized the system"
 
@@ -428,6 +1203,23 @@ def initialize():
 def health():
     return Response("OK", status=200)
 
+@application.route('/metrics')
+def metrics_endpoint():
+    """
+    Export the pipeline latency metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def db_pool_stats():
+    """
+    Database connection pool gauges, for the metrics endpoint
+    """
+    if not initialize_module or initialize_module.pool is None:
+        return {}
+    return {(stat,): value for stat, value in initialize_module.pool.stats().items()}
+
+metrics.CallbackGauge('db_pool_stats', 'Database connection pool size and connection wait times', db_pool_stats, ('stat',))
+
 def setup():
     """
     Setup to perform on load, before initialization
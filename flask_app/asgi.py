@@ -0,0 +1,124 @@
+"""
+ASGI entry point of the web app, eg. uvicorn asgi:application
+/answer and /feedback are served by the asyncio pipeline (async_pipeline.py), so requests that are
+waiting on Bedrock or Postgres don't hold a thread. All other routes are served by the Flask app
+from a thread pool.
+"""
+
+from a2wsgi import WSGIMiddleware
+from flask import request, render_template
+from admission import Overloaded
+import application as app_module
+import async_pipeline
+import metrics
+
+# Threads serving the routes that are delegated to the Flask app
+WSGI_THREADS = 8
+
+flask_app = WSGIMiddleware(app_module.application, workers=WSGI_THREADS)
+
+async def read_body(receive) -> bytes:
+    """
+    Read the full body of an http request
+    """
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return body
+
+def request_context(scope, body: bytes):
+    """
+    Flask request context for the ASGI request, so the form can be parsed and templates rendered
+    as in the Flask routes
+    """
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    return app_module.application.test_request_context(scope['path'], method=scope['method'], data=body,
+                                                       headers=headers, query_string=scope.get('query_string', b''))
+
+async def send_response(send, status: int, body: str, content_type: str = 'text/html; charset=utf-8', headers: dict = {}):
+    data = body.encode('utf-8')
+    headers = {'content-type': content_type, 'content-length': str(len(data)), **headers}
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': data})
+
+async def answer(scope, receive, send):
+    """
+    Async version of the /answer route
+    """
+    body = await read_body(receive)
+    with request_context(scope, body):
+        if not app_module.initialize_module:
+            # App is not yet initialized
+            return await send_response(send, 200, render_template('not_initialized.html',title=app_module.app_title))
+
+        with metrics.requests_in_flight.track(endpoint='/answer'), metrics.request_seconds.time(endpoint='/answer'):
+            # Submission from the form template
+            topic, question, program_info = app_module.read_question_form(request.form)
+            formatted_question = app_module.format_question(program_info, topic, question)
+            context_str = app_module.context_string(program_info, topic)
+
+            response = await async_pipeline.cached_answer_prompt(formatted_question, 3, context_str, program_info, question)
+
+            # Log the question, stored in the background by the feedback writer
+            app_module.log_question(question, context_str, response["answer"], [doc['doc_id'] for doc in response["docs"]])
+
+            html = app_module.render_answer(question, context_str, response, request.form.to_dict(), formatted_question)
+    await send_response(send, 200, html)
+
+async def feedback(scope, receive, send):
+    """
+    Async version of the /feedback route
+    The feedback is stored in the background by the feedback writer, so the request never waits on Lambda
+    """
+    body = await read_body(receive)
+    with request_context(scope, body):
+        app_module.submit_feedback(request.form)
+        html = render_template('feedback.html',title=app_module.app_title)
+    await send_response(send, 200, html)
+
+# Routes served by the asyncio pipeline, by (method, path)
+ASYNC_ROUTES = {
+    ('POST', '/answer'): answer,
+    ('POST', '/feedback'): feedback,
+}
+
+async def lifespan(receive, send):
+    """
+    Handle the server's startup and shutdown events
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_pipeline.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    handler = None
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        return await flask_app(scope, receive, send)
+
+    try:
+        await handler(scope, receive, send)
+    except Overloaded as e:
+        # Same response as the Flask app's error handler
+        print(f"Rejected request: {e}")
+        await send_response(send, 503, "The service is busy, please try again shortly", 'text/plain; charset=utf-8',
+                            headers={'retry-after': str(app_module.retry_after_seconds(e))})
+    except Exception as e:
+        print(f"Error when serving {scope['path']}: {e}")
+        await send_response(send, 500, 'Internal Server Error', 'text/plain; charset=utf-8')
@@ -0,0 +1,297 @@
+"""
+Asyncio version of the answer pipeline, used by the ASGI entry point (asgi.py)
+Bedrock and Postgres calls are awaited instead of blocking a thread, so one worker process
+can serve many questions that are waiting on the network at the same time.
+Prompts, document packing and caching are shared with the synchronous pipeline in application.py
+"""
+
+import os
+import json
+import asyncio
+import numpy as np
+import asyncpg
+from contextlib import AsyncExitStack
+from aiobotocore.session import AioSession
+from aiobotocore.config import AioConfig
+from pgvector.asyncpg import register_vector
+from asyncpg.exceptions import PostgresError
+import aws_helpers.client_registry as client_registry
+import application as app_module
+import metrics
+from metrics import timed
+from relevance_trailer import split_relevance_trailer
+
+### Constants
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 16
+
+# The combined KNN query of the synchronous pipeline, with asyncpg's positional parameters
+COMBINED_DOCS_SQL = app_module.COMBINED_DOCS_SQL
+for position, name in enumerate(['embedding', 'number'] + app_module.FILTER_KEYS, 1):
+    COMBINED_DOCS_SQL = COMBINED_DOCS_SQL.replace(f'%({name})s', f'${position}')
+
+### Globals (created on first use, in the server's event loop)
+bedrock_client = None
+bedrock_stack = None
+bedrock_generation = None # client_registry generation the client was created for
+db_pool = None
+db_pool_params = None # initialize module connection params the pool was created for
+resources_lock = asyncio.Lock()
+
+async def get_bedrock_client():
+    """
+    Return the shared async Bedrock runtime client
+    The client is re-created after the app is initialized, like the synchronous clients
+    """
+    global bedrock_client, bedrock_stack, bedrock_generation
+    async with resources_lock:
+        if bedrock_client is None or bedrock_generation != client_registry.generation:
+            if bedrock_stack is not None:
+                await bedrock_stack.aclose()
+            # Same credentials resolution as aws_helpers.get_session
+            session = AioSession(profile=os.environ.get("AWS_PROFILE_NAME"))
+            # Throttled calls are retried by the admission controller, not by the client
+            config = AioConfig(max_pool_connections=client_registry.MAX_POOL_CONNECTIONS,
+                               retries={'mode': 'standard', 'max_attempts': 1})
+            bedrock_stack = AsyncExitStack()
+            bedrock_client = await bedrock_stack.enter_async_context(
+                session.create_client('bedrock-runtime', region_name=app_module.REGION, config=config))
+            bedrock_generation = client_registry.generation
+        return bedrock_client
+
+async def configure_connection(conn):
+    """
+    Async version of initialize.configure_connection
+    asyncpg returns json and jsonb columns as text by default, they are decoded like psycopg2 does
+    """
+    await register_vector(conn)
+    for type_name in ['json', 'jsonb']:
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    try:
+        await conn.execute("SET hnsw.iterative_scan = relaxed_order")
+    except PostgresError as e:
+        print(f"Could not enable iterative index scans: {e}")
+
+async def get_db_pool():
+    """
+    Return the shared asyncpg connection pool, with each connection set up by configure_connection
+    The pool is re-created after the app is initialized, since the credentials may have changed
+    """
+    global db_pool, db_pool_params
+    params = app_module.initialize_module.connection_params
+    async with resources_lock:
+        if db_pool is None or db_pool_params is not params:
+            if db_pool is not None:
+                # Let in-flight queries finish on the old pool
+                asyncio.create_task(db_pool.close())
+            db_pool = await asyncpg.create_pool(database=params['dbname'], user=params['user'], password=params['password'],
+                                                host=params['host'], port=int(params['port']),
+                                                min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, init=configure_connection)
+            db_pool_params = params
+        return db_pool
+
+async def close():
+    """
+    Close the async clients and connection pool, on server shutdown
+    """
+    global bedrock_client, bedrock_stack, db_pool
+    async with resources_lock:
+        if bedrock_stack is not None:
+            await bedrock_stack.aclose()
+        if db_pool is not None:
+            await db_pool.close()
+        bedrock_client = bedrock_stack = db_pool = None
+
+def model_request_body(model_id, prompt):
+    """
+    Build the invoke_model request body of a text generation model, by model provider
+    """
+    provider = model_id.split('.')[0]
+    if provider == 'meta':
+        return {"prompt": prompt}
+    elif provider == 'amazon':
+        return {"inputText": prompt}
+    raise ValueError(f"Unsupported model provider '{provider}' for {model_id}")
+
+def model_response_text(model_id, response_body):
+    """
+    Read the generated text from the invoke_model response body of a text generation model
+    """
+    provider = model_id.split('.')[0]
+    if provider == 'meta':
+        return response_body['generation']
+    elif provider == 'amazon':
+        return response_body['results'][0]['outputText']
+    raise ValueError(f"Unsupported model provider '{provider}' for {model_id}")
+
+async def invoke_model(model_id, body):
+    """
+    Invoke a Bedrock model with the json body, returning the parsed response body
+    Calls go through the same admission control as the synchronous pipeline
+    """
+    bedrock = await get_bedrock_client()
+
+    async def invoke():
+        response = await bedrock.invoke_model(
+            body=json.dumps(body),
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        return json.loads(await response['body'].read())
+
+    return await app_module.admission.call_async(invoke)
+
+async def generate(prompt, model_id=app_module.MODEL_NAME):
+    """
+    Generate text for the prompt with a Bedrock model
+    """
+    response_body = await invoke_model(model_id, model_request_body(model_id, prompt))
+    return model_response_text(model_id, response_body)
+
+async def get_bedrock_embeddings(input_text, model_id=app_module.EMBEDDING_MODEL):
+    response_body = await invoke_model(model_id, {
+        "inputText": input_text,
+        "dimensions": app_module.VECTOR_DIMENSION,
+        "normalize": True
+    })
+    return response_body.get('embedding')
+
+async def get_combined_docs(query_embedding, number, filters=None):
+    """
+    Async version of application.get_combined_docs
+    """
+    sorted_docs = []
+    try:
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            filter_values = app_module.program_filters(filters or {})
+            rows = await conn.fetch(COMBINED_DOCS_SQL, np.array(query_embedding), number,
+                                    *[filter_values[key] for key in app_module.FILTER_KEYS])
+        sorted_docs = [app_module.doc_from_row(row) for row in rows]
+    except Exception as e:
+        print(f"Error when retrieving: {e}")
+    return sorted_docs
+
+async def embed_question(user_prompt):
+    """
+    Async version of application.embed_question, sharing its embedding cache
+    """
+    with timed('embedding'):
+        key = app_module.embedding_cache_key(user_prompt)
+        embedding = app_module.cached_embedding(key)
+        if embedding is None:
+            embedding = await get_bedrock_embeddings(user_prompt)
+            if embedding:
+                app_module.embedding_cache.put(key, embedding)
+        return embedding
+
+async def retrieve_docs(user_prompt, number_of_docs, embedding, filters=None):
+    """
+    Async version of application.retrieve_docs
+    """
+    with timed('knn_query'):
+        docs = await get_combined_docs(embedding, app_module.knn_fetch_count(number_of_docs), filters)
+
+    return app_module.select_docs(user_prompt, docs)
+
+async def check_document_relates(doc, user_prompt, model_id=app_module.MODEL_NAME):
+    with timed('relevance_check'):
+        return (await generate(app_module.relevance_prompt(doc, user_prompt, model_id), model_id)).strip()
+
+async def check_if_documents_relates(tasks, docs, timeout):
+    """
+    Wait for the relevance check tasks of the documents, for at most timeout seconds
+    Checks that have not finished are cancelled, and their documents are returned with 'relate' set to None
+    """
+    done = set()
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"{len(pending)} of {len(docs)} relevance checks did not finish within {app_module.RELEVANCE_CHECK_TIMEOUT}s")
+
+    doc_relates = []
+    for doc, task in zip(docs, tasks):
+        response = None
+        if task in done:
+            try:
+                response = task.result()
+            except Exception as e:
+                print(f"Error when checking document relevance: {e}")
+        doc_relates.append(app_module.doc_with_relevance(doc, response))
+    return doc_relates
+
+async def answer_prompt(user_prompt, number_of_docs, context_key='', filters=None, question=None):
+    """
+    Async version of application.answer_prompt
+    In the 'per_document' relevance mode, the relevance checks don't depend on the answer,
+    so they run concurrently with the generation
+    """
+    app_module.validate_answer_input(user_prompt, number_of_docs)
+
+    embedding = await embed_question(user_prompt)
+
+    # A similar enough question may already have been answered, matched on the bare question
+    # as in application.semantic_cache_embedding
+    partition = app_module.semantic_cache_partition(context_key, number_of_docs)
+    question_embedding = embedding if not question or question == user_prompt else await embed_question(question)
+    cached = app_module.semantic_cache_get(question_embedding, partition)
+    if cached is not None:
+        return cached
+
+    divided_docs = await retrieve_docs(user_prompt, number_of_docs, embedding, filters)
+    inline = app_module.RELEVANCE_MODE == 'inline'
+    model_id = app_module.route_question(user_prompt, divided_docs)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + app_module.RELEVANCE_CHECK_TIMEOUT
+    tasks = [] if inline else [asyncio.ensure_future(check_document_relates(doc, user_prompt, model_id)) for doc in divided_docs["docs"]]
+
+    try:
+        with timed('generation'):
+            output = await generate(app_module.generation_prompt(user_prompt, app_module.format_docs(divided_docs["docs"]), model_id),
+                                    model_id)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if inline:
+        answer, judgments = split_relevance_trailer(output)
+        # Fall back to checking the documents the model did not explain
+        missing = [idx for idx in range(len(divided_docs["docs"])) if idx + 1 not in judgments]
+        tasks = [asyncio.ensure_future(check_document_relates(divided_docs["docs"][idx], user_prompt, model_id)) for idx in missing]
+        checked_missing = await check_if_documents_relates(tasks, [divided_docs["docs"][idx] for idx in missing],
+                                                           app_module.RELEVANCE_CHECK_TIMEOUT)
+        checked = [app_module.doc_with_relevance(doc, judgments.get(number)) for number, doc in enumerate(divided_docs["docs"], 1)]
+        for idx, doc in zip(missing, checked_missing):
+            checked[idx] = doc
+    else:
+        answer = output
+        checked = await check_if_documents_relates(tasks, divided_docs["docs"], max(0, deadline - loop.time()))
+
+    # The removed documents are explained on demand, when the user expands them
+    response = {"answer": answer,
+                "docs": checked,
+                "removed_docs": [app_module.doc_with_relevance(doc, None) for doc in divided_docs["removed_docs"]]}
+    if app_module.is_cacheable(response):
+        app_module.semantic_cache.put(question_embedding, partition, response)
+    return response
+
+async def cached_answer_prompt(user_prompt, number_of_docs, context_key='', filters=None, question=None):
+    """
+    Async version of application.cached_answer_prompt
+    The answer cache may read and write a sqlite file, so it is accessed from a thread
+    """
+    key = app_module.answer_cache_key(user_prompt, number_of_docs)
+    response = await asyncio.to_thread(app_module.answer_cache.get, key)
+    metrics.cache_lookups.inc(cache='answer', result='miss' if response is None else 'hit')
+    if response is None:
+        response = app_module.remember_question(user_prompt, await answer_prompt(user_prompt, number_of_docs, context_key, filters, question))
+        if app_module.is_cacheable(response):
+            await asyncio.to_thread(app_module.answer_cache.put, key, response)
+    else:
+        response = app_module.remember_question(user_prompt, response)
+    return response
@@ -0,0 +1,6 @@
+from .answer_cache import AnswerCache, normalize_question
+from .semantic_cache import SemanticCache
+from .question_store import QuestionStore
+from .embedding_cache import EmbeddingCache
+
+__all__ = ['AnswerCache','normalize_question','SemanticCache','QuestionStore','EmbeddingCache']
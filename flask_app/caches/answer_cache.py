@@ -0,0 +1,133 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+def normalize_question(question: str) -> str:
+    """
+    Normalize a question for use in a cache key
+    Lowercases and collapses whitespace, so trivially different submissions share an entry
+    """
+    return re.sub(r'\s+', ' ', question).strip().lower()
+
+class AnswerCache():
+    """
+    LRU cache of full answer responses.
+    Entries are keyed by the normalized question, the model name and the corpus version
+    (the latest update_logs row), so answers are never served across a document update.
+    If a path is given, entries are also persisted to a sqlite file so they are shared
+    between worker processes and survive restarts.
+    """
+
+    def __init__(self, max_size: int = 256, path: Optional[str] = None):
+        """
+        - max_size: max number of entries kept in memory, and on disk if persisted
+        - path: optional path of the sqlite file to persist entries to
+        """
+        self.max_size = max_size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path:
+            with self._connect() as db:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS answers (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        last_used REAL NOT NULL
+                    )""")
+
+    @staticmethod
+    def make_key(question: str, model_name: str, corpus_version: str, *extra) -> str:
+        """
+        Build the cache key for a question
+        - extra: any other arguments that change the response (eg. number of documents)
+        """
+        parts = [normalize_question(question), model_name, str(corpus_version)] + [str(part) for part in extra]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _connect(self):
+        """
+        Open a connection to the sqlite file, committing and closing it afterwards
+        Connections are opened per operation since sqlite connections can't be shared between threads
+        """
+        db = sqlite3.connect(self.path, timeout=5)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Return the cached response for the key, or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if not self.path:
+            return None
+
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT value FROM answers WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"Error reading from the answer cache: {e}")
+            return None
+
+        value = json.loads(row[0])
+        self._put_memory(key, value)
+        return value
+
+    def put(self, key: str, value: Dict):
+        """
+        Cache a response, evicting the least recently used entries above max_size
+        The value must be json serializable if the cache is persisted
+        """
+        self._put_memory(key, value)
+
+        if not self.path:
+            return
+
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO answers (key, value, last_used) VALUES (?, ?, ?)",
+                           (key, json.dumps(value), time.time()))
+                db.execute("""
+                    DELETE FROM answers WHERE key NOT IN (
+                        SELECT key FROM answers ORDER BY last_used DESC LIMIT ?
+                    )""", (self.max_size,))
+        except sqlite3.Error as e:
+            print(f"Error writing to the answer cache: {e}")
+
+    def _put_memory(self, key: str, value: Dict):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries, including persisted ones
+        """
+        with self._lock:
+            self._entries.clear()
+
+        if self.path:
+            try:
+                with self._connect() as db:
+                    db.execute("DELETE FROM answers")
+            except sqlite3.Error as e:
+                print(f"Error clearing the answer cache: {e}")
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+from .answer_cache import normalize_question
+
+class EmbeddingCache():
+    """
+    LRU cache of question embeddings.
+    Entries are keyed by the normalized text, the embedding model id and the embedding dimension.
+    If a path is given, entries are also stored in a memory-mapped float32 .npy file, shared by
+    all worker processes mapping the same file and kept across restarts.
+    The file is a fixed size hash table of disk_slots entries; an entry replaces any older entry
+    that hashes to the same slot. Reads and writes take no locks: a writer clears the slot's key,
+    writes the vector and a checksum of it, then sets the key. A reader checks the key before and
+    after copying the vector, and checks the copy against the checksum, so a read racing one or more
+    writes of the slot (eg. two processes writing different keys at once) is a miss rather than a torn vector.
+    """
+
+    def __init__(self, dimension: int, max_size: int = 4096, path: Optional[str] = None, disk_slots: int = 65536):
+        """
+        - dimension: dimension of the embeddings
+        - max_size: max number of entries kept in memory
+        - path: optional path of the .npy file to store entries in
+        - disk_slots: number of entries of the file, if persisted
+        """
+        self.dimension = dimension
+        self.max_size = max_size
+        self.path = path
+        self.disk_slots = disk_slots
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = self._open_disk() if path else None
+
+    @staticmethod
+    def make_key(text: str, model_id: str, dimension: int) -> int:
+        """
+        Build the cache key of a text, a non-zero 63 bit hash (zero marks empty slots on disk)
+        """
+        parts = [normalize_question(text), model_id, str(dimension)]
+        digest = hashlib.sha256('\x1f'.join(parts).encode('utf-8')).digest()
+        return (int.from_bytes(digest[:8], 'little') >> 1) or 1
+
+    @staticmethod
+    def _checksum(vector: np.ndarray) -> int:
+        """
+        63 bit checksum of a float32 vector, stored with the vector on disk
+        """
+        digest = hashlib.blake2b(vector.tobytes(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') >> 1
+
+    def _open_disk(self):
+        """
+        Map the file, creating it if it does not exist or was made for a different dimension or size
+        """
+        dtype = np.dtype([('key', '<i8'), ('checksum', '<i8'), ('vector', '<f4', (self.dimension,))])
+        try:
+            disk = np.lib.format.open_memmap(self.path, mode='r+')
+            if disk.dtype == dtype and disk.shape == (self.disk_slots,):
+                return disk
+            print(f"Embedding cache file {self.path} has a different layout, re-creating it")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Error opening the embedding cache file, re-creating it: {e}")
+
+        try:
+            # Created under a temporary name, so other workers never map a partially written header
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            disk = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(self.disk_slots,))
+            disk.flush()
+            os.replace(temp_path, self.path)
+            return disk
+        except OSError as e:
+            print(f"Error creating the embedding cache file, only caching in memory: {e}")
+            return None
+
+    def get(self, key: int) -> Optional[List[float]]:
+        """
+        Return the cached embedding for the key, or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self._disk is None:
+            return None
+
+        keys, checksums, vectors = self._disk['key'], self._disk['checksum'], self._disk['vector']
+        slot = key % self.disk_slots
+        if keys[slot] != key:
+            return None
+        vector = vectors[slot].copy()
+        checksum = int(checksums[slot])
+        if keys[slot] != key or self._checksum(vector) != checksum:
+            return None
+
+        embedding = vector.tolist()
+        self._put_memory(key, embedding)
+        return embedding
+
+    def put(self, key: int, embedding: List[float]):
+        """
+        Cache an embedding, evicting the least recently used entries above max_size
+        """
+        self._put_memory(key, embedding)
+
+        if self._disk is None or len(embedding) != self.dimension:
+            return
+
+        vector = np.asarray(embedding, dtype='<f4')
+        keys, checksums, vectors = self._disk['key'], self._disk['checksum'], self._disk['vector']
+        slot = key % self.disk_slots
+        keys[slot] = 0
+        vectors[slot] = vector
+        checksums[slot] = self._checksum(vector)
+        keys[slot] = key
+
+    def _put_memory(self, key: int, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: int) -> bool:
+        return self.get(key) is not None
+
+    def clear(self):
+        """
+        Remove all entries, including persisted ones
+        """
+        with self._lock:
+            self._entries.clear()
+
+        if self._disk is not None:
+            self._disk['key'] = 0
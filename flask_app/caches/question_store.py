@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+class QuestionStore():
+    """
+    LRU store of recently answered questions and their removed documents,
+    so the relevance of a removed document can be explained on demand.
+    Explanations are kept once computed, so each one takes at most one LLM call per question.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """
+        - max_size: max number of questions kept
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, question_id: str, question: str, docs: List[Dict]):
+        """
+        Keep the question and its documents, adding the documents that are not stored yet if the question is
+        """
+        with self._lock:
+            if question_id not in self._entries:
+                self._entries[question_id] = {"question": question, "docs": {}}
+            stored_docs = self._entries[question_id]["docs"]
+            for doc in docs:
+                stored_docs.setdefault(str(doc['doc_id']), dict(doc))
+            self._entries.move_to_end(question_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_doc(self, question_id: str, doc_id: str) -> Optional[Tuple[str, Dict]]:
+        """
+        Return the question and the stored document, or None if either is unknown
+        The document's 'relate' is set if its relevance was already explained
+        """
+        with self._lock:
+            entry = self._entries.get(question_id)
+            if entry is None or str(doc_id) not in entry["docs"]:
+                return None
+            self._entries.move_to_end(question_id)
+            return entry["question"], entry["docs"][str(doc_id)]
+
+    def set_relate(self, question_id: str, doc_id: str, relate: str):
+        """
+        Keep the relevance explanation of a document
+        """
+        with self._lock:
+            entry = self._entries.get(question_id)
+            if entry is not None and str(doc_id) in entry["docs"]:
+                entry["docs"][str(doc_id)]["relate"] = relate
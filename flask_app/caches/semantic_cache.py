@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import numpy as np
+from typing import Dict, List, Optional
+
+class SemanticCache():
+    """
+    Cache of full answer responses, looked up by the embedding of the question.
+    A question whose embedding is within max_distance (cosine distance) of a cached question
+    gets the cached response, so rephrasings of a question share an entry.
+    Entries are partitioned (eg. by program context, model name and corpus version), and are only
+    matched against entries of the same partition.
+    Embeddings are kept in a single matrix, so a lookup is one matrix-vector product.
+    When full, the oldest entries are replaced first.
+    """
+
+    def __init__(self, dimension: int, max_size: int = 1024, max_distance: float = 0.08):
+        """
+        - dimension: dimension of the question embeddings
+        - max_size: max number of cached responses
+        - max_distance: max cosine distance between questions to share a response
+        """
+        self.dimension = dimension
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self.clear()
+
+    @staticmethod
+    def make_partition(*parts) -> str:
+        """
+        Build the partition key of an entry, from anything that must match exactly for a cached response to be reused
+        """
+        return '\x1f'.join(str(part) for part in parts)
+
+    @staticmethod
+    def _partition_id(partition: str) -> int:
+        """
+        Fixed-size integer id of a partition, a non-negative 63 bit hash
+        Hashed rather than numbered, so no state is kept per partition and partitions never accumulate
+        """
+        digest = hashlib.sha256(partition.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'little') >> 1
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, embedding: List[float], partition: str) -> Optional[Dict]:
+        """
+        Return the cached response of the closest question in the partition,
+        or None if there is none within max_distance
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            partition_id = self._partition_id(partition)
+            if self._size == 0:
+                return None
+            similarities = self._embeddings[:self._size] @ vector
+            similarities[self._partitions[:self._size] != partition_id] = -np.inf
+            best = int(np.argmax(similarities))
+            if 1 - similarities[best] > self.max_distance:
+                return None
+            return self._responses[best]
+
+    def put(self, embedding: List[float], partition: str, response: Dict):
+        """
+        Cache the response to a question, replacing the oldest entry if the cache is full
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            idx = self._next
+            self._embeddings[idx] = vector
+            self._partitions[idx] = self._partition_id(partition)
+            self._responses[idx] = response
+            self._next = (idx + 1) % self.max_size
+            self._size = min(self._size + 1, self.max_size)
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._embeddings = np.zeros((self.max_size, self.dimension), dtype=np.float32)
+            self._partitions = np.full(self.max_size, -1, dtype=np.int64)
+            self._responses = [None] * self.max_size
+            self._next = 0
+            self._size = 0
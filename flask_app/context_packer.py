@@ -0,0 +1,163 @@
+"""
+Packs retrieved documents into the token budget of the generation prompt
+Run as a script to download the tokenizers into TOKENIZER_DIR, which is done when building the image
+"""
+
+import os
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+# Tokenizers are loaded from local files, bundled in the image, so nothing is downloaded at runtime
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tokenizers'))
+# Tokenizers for the supported Bedrock models: (directory under TOKENIZER_DIR, Huggingface repo to download it from)
+# The Llama 3 models share a tokenizer, downloaded from an ungated copy of Meta's repo so no access token is needed
+TOKENIZERS = {
+    "meta.llama3-8b-instruct-v1:0": ("llama3", "NousResearch/Meta-Llama-3-8B-Instruct"),
+    "meta.llama3-70b-instruct-v1:0": ("llama3", "NousResearch/Meta-Llama-3-8B-Instruct"),
+}
+# Context window of the supported Bedrock models, in tokens
+CONTEXT_WINDOWS = {
+    "meta.llama3-8b-instruct-v1:0": 8192,
+    "meta.llama3-70b-instruct-v1:0": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Used to estimate token counts when no tokenizer is available for the model
+# Deliberately low so the estimate errs towards overcounting
+CHARS_PER_TOKEN_ESTIMATE = 3
+
+class TokenCounter():
+    """
+    Counts tokens with the tokenizer of a Bedrock model
+    Falls back to a conservative character based estimate if the tokenizer can't be loaded
+    (eg. transformers is not installed, the tokenizer files were not bundled, or the model has no known tokenizer)
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.context_window = CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW)
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the tokenizer from TOKENIZER_DIR, called upon startup so requests never wait on it
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            if self.model_name in TOKENIZERS:
+                path = os.path.join(TOKENIZER_DIR, TOKENIZERS[self.model_name][0])
+                try:
+                    from transformers import AutoTokenizer
+                    self._tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+                except Exception as e:
+                    print(f"ERROR could not load the tokenizer for {self.model_name} from {path}, "
+                          f"token counts are estimated and documents may be dropped or overflow the context window: {e}")
+            else:
+                print(f"ERROR no tokenizer known for {self.model_name}, token counts are estimated")
+            self._loaded = True
+
+    def count(self, text: str) -> int:
+        """
+        Return the number of tokens in the text
+        """
+        if not self._loaded:
+            self.load()
+        if self._tokenizer is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN_ESTIMATE)
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+class ContextPacker():
+    """
+    Selects the documents that fit in a token budget, in a single pass.
+    Documents are formatted as in application.format_docs:
+        "Document {idx}:\n{text}" joined by newlines
+    Token counts of document texts are cached, so repeated documents are only tokenized once.
+    """
+
+    def __init__(self, token_counter: TokenCounter, cache_size: int = 4096):
+        """
+        - token_counter: counts tokens for the generation model
+        - cache_size: max number of document token counts to cache
+        """
+        self.token_counter = token_counter
+        self.cache_size = cache_size
+        self._doc_tokens = OrderedDict()
+        self._header_tokens = {}
+        self._lock = threading.Lock()
+
+    def doc_tokens(self, doc: Dict) -> int:
+        """
+        Return the number of tokens in the document's text, from the cache if possible
+        """
+        key = hashlib.sha1(doc['text'].encode('utf-8')).digest()
+        with self._lock:
+            if key in self._doc_tokens:
+                self._doc_tokens.move_to_end(key)
+                return self._doc_tokens[key]
+
+        tokens = self.token_counter.count(doc['text'])
+
+        with self._lock:
+            self._doc_tokens[key] = tokens
+            while len(self._doc_tokens) > self.cache_size:
+                self._doc_tokens.popitem(last=False)
+        return tokens
+
+    def header_tokens(self, idx: int) -> int:
+        """
+        Return the number of tokens added by formatting the document at position idx (1-indexed),
+        including the newline separating it from the previous document
+        """
+        if idx not in self._header_tokens:
+            self._header_tokens[idx] = self.token_counter.count(f"\nDocument {idx}:\n")
+        return self._header_tokens[idx]
+
+    def pack(self, docs: List[Dict], budget: int, strategy: str = 'greedy') -> Dict:
+        """
+        Split the documents into those that fit in the budget and those that don't
+        - docs: documents sorted by relevance, with 'text' and 'score' (distance, lower is better)
+        - budget: max number of tokens for the formatted documents
+        - strategy: 'greedy' keeps documents in relevance order, skipping any that don't fit
+                    'density' prefers documents with the most relevance per token
+        Returns a dict of the kept 'docs' (in their original order), the 'removed_docs',
+        and the number of 'tokens' used by the kept documents
+        """
+        if strategy == 'greedy':
+            order = list(range(len(docs)))
+        elif strategy == 'density':
+            # Relevance is the cosine similarity, 1 - distance
+            order = sorted(range(len(docs)), key=lambda i: -max(1 - docs[i]['score'], 1e-6) / max(self.doc_tokens(docs[i]), 1))
+        else:
+            raise ValueError(f"Unsupported packing strategy '{strategy}', choices are 'greedy' or 'density'")
+
+        # Headers are counted at the highest possible index, since kept documents are renumbered
+        header_idx = len(docs) if strategy == 'density' else None
+
+        kept = set()
+        used = 0
+        for i in order:
+            cost = self.doc_tokens(docs[i]) + self.header_tokens(header_idx or len(kept) + 1)
+            if used + cost <= budget:
+                kept.add(i)
+                used += cost
+
+        return {"docs": [doc for i, doc in enumerate(docs) if i in kept],
+                "removed_docs": [doc for i, doc in enumerate(docs) if i not in kept],
+                "tokens": used}
+
+def download_tokenizers(path: str = TOKENIZER_DIR):
+    """
+    Download the tokenizers of the supported models into path
+    """
+    from transformers import AutoTokenizer
+    for directory, repo in set(TOKENIZERS.values()):
+        AutoTokenizer.from_pretrained(repo).save_pretrained(os.path.join(path, directory))
+        print(f"Saved the tokenizer of {repo} to {os.path.join(path, directory)}")
+
+if __name__ == "__main__":
+    download_tokenizers()
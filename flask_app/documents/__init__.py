@@ -1,4 +1,5 @@
-from .doc_graph_utils import load_graph, get_split_sib_ids
+from .doc_graph_utils import load_graph, get_split_sib_ids, SplitChainIndex
+from .compiled_graph import CompiledGraph
 from .doc_loader import load_docs
 
-__all__ = ['load_docs', 'load_graph', 'get_split_sib_ids']
\ No newline at end of file
+__all__ = ['load_docs', 'load_graph', 'get_split_sib_ids', 'SplitChainIndex', 'CompiledGraph']
\ No newline at end of file
@@ -0,0 +1,68 @@
+import os
+import json
+import numpy as np
+from typing import List, Optional
+
+# Files of a compiled graph, written by compile_graph in document_scraping/website_dump_doc_extractor.py
+META_FILENAME = 'meta.json'
+COMPILED_GRAPH_VERSION = 1
+
+class CompiledGraph():
+    """
+    Read-only document relationship graph, backed by memory-mapped arrays in compressed sparse row format.
+    There is one block of rows per relation type and direction ('out' or 'in'): the neighbours of the node at
+    position i in block b are targets[offsets[b, i]:offsets[b, i + 1]], so a typed neighbour lookup
+    only reads the node's own neighbours. Loading maps the files without reading them.
+    """
+
+    def __init__(self, node_ids: np.ndarray, offsets: np.ndarray, targets: np.ndarray, blocks: List[dict]):
+        """
+        - node_ids: sorted doc_ids of the nodes
+        - offsets: (number of blocks, number of nodes + 1) array of the start of each node's neighbours in targets
+        - targets: doc_ids of the neighbours
+        - blocks: the relation and direction of each block of offsets
+        """
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.block_index = {(block['relation'], block['direction']): idx for idx, block in enumerate(blocks)}
+        # Doc ids are usually 0..n-1, so the position of a node is its doc_id
+        self.dense = len(node_ids) == 0 or (node_ids[0] == 0 and node_ids[-1] == len(node_ids) - 1)
+
+    @classmethod
+    def load(cls, path: str) -> 'CompiledGraph':
+        """
+        Memory-map a compiled graph from its directory
+        """
+        with open(os.path.join(path, META_FILENAME)) as f:
+            meta = json.load(f)
+        if meta['version'] != COMPILED_GRAPH_VERSION:
+            raise ValueError(f"Unsupported compiled graph version {meta['version']}, expected {COMPILED_GRAPH_VERSION}")
+        arrays = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ['node_ids', 'offsets', 'targets']]
+        return cls(*arrays, meta['blocks'])
+
+    def _position(self, doc_id: int) -> Optional[int]:
+        """
+        Return the row of the node in the blocks, or None if the graph does not have the node
+        """
+        if self.dense:
+            return doc_id if 0 <= doc_id < len(self.node_ids) else None
+        pos = int(np.searchsorted(self.node_ids, doc_id))
+        return pos if pos < len(self.node_ids) and self.node_ids[pos] == doc_id else None
+
+    def neighbours(self, doc_id: int, relation: int, direction: str = 'out') -> List[int]:
+        """
+        Return the ids of the documents related to the document by the relation
+        - direction: 'out' for the documents the document has an edge to, 'in' for the documents with an edge to it
+        """
+        pos = self._position(doc_id)
+        block = self.block_index.get((int(relation), direction))
+        if pos is None or block is None:
+            return []
+        return self.targets[self.offsets[block, pos]:self.offsets[block, pos + 1]].tolist()
+
+    def __contains__(self, doc_id: int) -> bool:
+        return self._position(doc_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
@@ -1,6 +1,8 @@
-from typing import List
+from typing import List, Dict, Optional, Union
+import os
 import networkx as nx
 from enum import IntEnum
+from .compiled_graph import CompiledGraph, META_FILENAME
 
 class DocRelation(IntEnum):
     """
@@ -12,26 +14,40 @@ class DocRelation(IntEnum):
     SIBLING_EXTRACT = 4
     SIBLING_SPLIT_EXTRACT = 5
 
-def load_graph(filepath) -> nx.DiGraph:
+def load_graph(filepath) -> Union[nx.DiGraph, CompiledGraph]:
     """
     Read the website relationship graph from file
+    If the compiled graph is next to the adjacency list file (eg. website_graph/ for website_graph.txt),
+    it is memory-mapped instead of parsing the adjacency list
     """
+    compiled_path = os.path.splitext(filepath)[0]
+    if os.path.exists(os.path.join(compiled_path, META_FILENAME)):
+        try:
+            return CompiledGraph.load(compiled_path)
+        except Exception as e:
+            print(f"Could not load the compiled graph, reading {filepath}: {e}")
     graph = nx.read_multiline_adjlist(filepath, create_using=nx.DiGraph, nodetype = int)
     return graph 
 
-def get_doc_relation_ids(graph: nx.DiGraph, doc_id: int, relation: DocRelation, in_only = False, out_only = False, only_one=False) -> List[int]:
+def get_doc_relation_ids(graph: Union[nx.DiGraph, CompiledGraph], doc_id: int, relation: DocRelation, in_only = False, out_only = False, only_one=False) -> List[int]:
     """
     Return the ids of documents related to the given document by the given relation
     """
     out_ids = []
-    if not out_only:
-        for (id2,_,data) in list(graph.in_edges([doc_id],data=True)):
-            if data['type'] == int(relation):
-                out_ids.append(id2)
-    if not in_only: 
-        for (_,id2,data) in list(graph.out_edges([doc_id],data=True)):
-            if data['type'] == int(relation):
-                out_ids.append(id2)
+    if isinstance(graph, CompiledGraph):
+        if not out_only:
+            out_ids += graph.neighbours(doc_id, relation, 'in')
+        if not in_only:
+            out_ids += graph.neighbours(doc_id, relation, 'out')
+    else:
+        if not out_only:
+            for (id2,_,data) in graph.in_edges([doc_id],data=True):
+                if data['type'] == int(relation):
+                    out_ids.append(id2)
+        if not in_only: 
+            for (_,id2,data) in graph.out_edges([doc_id],data=True):
+                if data['type'] == int(relation):
+                    out_ids.append(id2)
 
     if only_one:
         if len(out_ids) == 1: 
@@ -55,6 +71,61 @@ def get_split_sib_ids(graph: nx.DiGraph, doc_id: int):
     
     return ids
 
+class SplitChainIndex():
+    """
+    Chains of split extracts (SIBLING_SPLIT_EXTRACT relations) of the documents.
+    The chain of a document is the same as get_split_sib_ids: its previous splits, the document,
+    and its next splits, in order. A split with more than one previous or next split ends the chain there.
+    For a compiled graph, the chains are walked from its memory-mapped arrays when needed, so nothing is
+    loaded up front. For a networkx graph, the split links are indexed in a single pass over its edges.
+    """
+
+    def __init__(self, graph: Union[nx.DiGraph, CompiledGraph]):
+        self.graph = graph
+        self.prev_ids: Dict[int, int] = {}
+        self.next_ids: Dict[int, int] = {}
+        if isinstance(graph, CompiledGraph):
+            return
+
+        prev_candidates = {}
+        next_candidates = {}
+        for (id1,id2,data) in graph.edges(data=True):
+            if data['type'] == int(DocRelation.SIBLING_SPLIT_EXTRACT):
+                next_candidates.setdefault(id1, []).append(id2)
+                prev_candidates.setdefault(id2, []).append(id1)
+        self.prev_ids = {doc_id: ids[0] for doc_id, ids in prev_candidates.items() if len(ids) == 1}
+        self.next_ids = {doc_id: ids[0] for doc_id, ids in next_candidates.items() if len(ids) == 1}
+
+    def _linked_id(self, doc_id: int, direction: str) -> Optional[int]:
+        """
+        Return the previous ('in') or next ('out') split of the document, if it has exactly one
+        """
+        if isinstance(self.graph, CompiledGraph):
+            ids = self.graph.neighbours(doc_id, DocRelation.SIBLING_SPLIT_EXTRACT, direction)
+            return ids[0] if len(ids) == 1 else None
+        return (self.prev_ids if direction == 'in' else self.next_ids).get(doc_id)
+
+    def chain(self, doc_id: int) -> List[int]:
+        """
+        Return the ids of the document's chain of splits, including the document itself
+        The walk stops if the chain loops
+        """
+        seen = {doc_id}
+        before = []
+        prev_id = self._linked_id(doc_id, 'in')
+        while prev_id is not None and prev_id not in seen:
+            before.append(prev_id)
+            seen.add(prev_id)
+            prev_id = self._linked_id(prev_id, 'in')
+
+        after = []
+        next_id = self._linked_id(doc_id, 'out')
+        while next_id is not None and next_id not in seen:
+            after.append(next_id)
+            seen.add(next_id)
+            next_id = self._linked_id(next_id, 'out')
+        return before[::-1] + [doc_id] + after
+
 def get_doc_sib_ids(graph: nx.DiGraph, doc_id: int) -> List[int]:
     """
     Return the ids of the given document's previous and next sibling documents
@@ -1,10 +1,45 @@
 import json
-from aws_helpers.get_session import get_session
+import time
+import queue
+import random
+import atexit
+import threading
+from aws_helpers.client_registry import get_client
 import os
 
 LAMBDA_FUNCTION_NAME = os.environ["FEEDBACK_LAMBDA"]
 AWS_DEFAULT_REGION = os.environ["AWS_DEFAULT_REGION"]
 
+### Background writer settings
+BATCH_SIZE = 25 # Max number of records stored per Lambda invocation
+FLUSH_INTERVAL = 5 # Max seconds a record waits in the queue before being flushed
+MAX_QUEUE_SIZE = 10000 # Records submitted while the queue is full are dropped
+MAX_RETRIES = 5 # Number of retries of a failed Lambda invocation
+BACKOFF_BASE = 0.5 # Seconds to wait before the first retry, doubles after every retry
+SHUTDOWN_TIMEOUT = 10 # Max seconds to wait for the queue to drain on shutdown
+INVALID_RECORDS_STATUS = 400 # Status of a response where only invalid records were not stored, not retried
+
+def invoke_lambda(event: dict):
+    """
+    Invoke the feedback Lambda function with the event
+    Return a dictionary of the JSON response
+    """
+    # need region_name when running from EC2/ECS, or AWS_DEFAULT_REGION env variable
+    lambda_client = get_client("lambda", region_name=AWS_DEFAULT_REGION)
+
+    # Invoke the Lambda function
+    response = lambda_client.invoke(
+        FunctionName=LAMBDA_FUNCTION_NAME,
+        InvocationType='RequestResponse',  # Set to 'Event' for asynchronous invocation
+        Payload=json.dumps(event)
+    )
+
+    if 'FunctionError' in response:
+        raise RuntimeError(f"Lambda function error: {response['Payload'].read()}")
+    
+    # Parse and return the response from the Lambda function
+    return json.loads(response['Payload'].read())
+
 def store_feedback(json_payload: str, logging_only: bool = False):
     """
     Invoke a Lambda Function to store the feedback into the PostgreSQL database
@@ -17,24 +52,128 @@ def store_feedback(json_payload: str, logging_only: bool = False):
     Return:
         A dictionary of the JSON response
     """
-
-    session = get_session()
-    # need region_name when running from EC2/ECS, or AWS_DEFAULT_REGION env variable
-    lambda_client = session.client("lambda", region_name=AWS_DEFAULT_REGION) 
-
-    input = json.dumps({
+    return invoke_lambda({
         'logging': logging_only,
         'payload': json_payload
     })
-    
-    print(input)
-    
-    # Invoke the Lambda function
-    response = lambda_client.invoke(
-        FunctionName=LAMBDA_FUNCTION_NAME,
-        InvocationType='RequestResponse',  # Set to 'Event' for asynchronous invocation
-        Payload=input
-    )
 
-    # Parse and return the response from the Lambda function
-    return json.loads(response['Payload'].read())
\ No newline at end of file
+def store_feedback_batch(records: list):
+    """
+    Invoke the Lambda Function once to store a batch of records
+
+    Arguments:
+        records: list of dicts with the keys 'logging' and 'payload', as in store_feedback
+    Return:
+        A dictionary of the JSON response
+    """
+    return invoke_lambda({'records': records})
+
+class FeedbackWriter():
+    """
+    Stores feedback and question logs in the background, off the request path.
+    Submitted records are queued in memory, and a background thread stores them in batches
+    once BATCH_SIZE records are queued or the oldest has waited FLUSH_INTERVAL seconds.
+    Failed invocations, and batches the Lambda could not store (eg. the database was unavailable),
+    are retried with exponential backoff, and the queue is drained when the process shuts down.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL, 
+                 max_queue_size: int = MAX_QUEUE_SIZE, max_retries: int = MAX_RETRIES):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """
+        Start the background thread if it is not running
+        Started lazily since threads don't survive the fork of a preloaded worker
+        """
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='feedback-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, json_payload: str, logging_only: bool = False) -> bool:
+        """
+        Queue a record to be stored, without blocking
+        Arguments are the same as store_feedback
+        Return false if the record was dropped because the writer is stopped or the queue is full
+        """
+        if self._stop.is_set():
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait({'logging': logging_only, 'payload': json_payload})
+            return True
+        except queue.Full:
+            print("ERROR feedback queue is full, dropping record")
+            return False
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _next_batch(self) -> list:
+        """
+        Wait for the next batch of records
+        Returns once the batch is full, or flush_interval seconds after its first record
+        """
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if self._stop.is_set():
+                # Shutting down, don't wait for more records
+                timeout = 0
+            try:
+                batch.append(self._queue.get(timeout=max(timeout, 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: list):
+        """
+        Store the batch, retrying with jittered exponential backoff on failure
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = store_feedback_batch(batch)
+                if response.get("statusCode") == 200:
+                    return
+                if response.get("statusCode") == INVALID_RECORDS_STATUS:
+                    # The valid records were stored, retrying would not store the invalid ones
+                    print(f"ERROR {response.get('msg')}: {response.get('body')}")
+                    return
+                raise RuntimeError(f"{response.get('msg')} (status {response.get('statusCode')}): {response.get('body')}")
+            except Exception as e:
+                # Handle any exceptions that occur during the Lambda invocation
+                print(f"ERROR occurs when submitting the feedback to the database (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries and not self._stop.is_set():
+                    time.sleep(BACKOFF_BASE * (2 ** attempt) * random.uniform(0.5, 1.5))
+        print(f"ERROR dropping {len(batch)} feedback records after {self.max_retries + 1} attempts")
+
+    def close(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """
+        Stop accepting records, and wait up to timeout seconds for the queued records to be stored
+        """
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+# The module is reloaded by the /initialize endpoint, drain the writer of the previous load
+if globals().get('writer') is not None:
+    writer.close()
+
+writer = FeedbackWriter()
+atexit.register(writer.close)
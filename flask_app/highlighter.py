@@ -0,0 +1,152 @@
+"""
+Highlighting of the sections of a document that an LLM extracted as relevant (the compressed document).
+The extracted sentences are matched as plain text, never as regex patterns, all at once with an
+Aho–Corasick automaton. Runs of whitespace are collapsed on both sides before matching, so sentences
+still match when the LLM changed the line breaks or spacing. The highlighted text is built in a single
+pass over the original text, placing italics markings around each line of each matched section.
+"""
+
+import re
+from typing import Dict, Iterator, List, Tuple
+
+# List numbering that some LLMs add to each returned sentence, eg. '1. ' or '2) '
+NUMBERING_PATTERN = re.compile(r'^\d+[.)]\s+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+class AhoCorasick():
+    """
+    Multi-pattern string matcher, finding every occurrence of all patterns in one pass over a text
+    """
+
+    def __init__(self, patterns: List[str]):
+        # Trie of the patterns, with the failure link of each node and the length
+        # of the longest pattern that ends at the node (including through failure links)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._longest: List[int] = [0]
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        node = 0
+        for char in pattern:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._longest.append(0)
+                self._goto[node][char] = len(self._goto) - 1
+            node = self._goto[node][char]
+        self._longest[node] = max(self._longest[node], len(pattern))
+
+    def _link(self):
+        """
+        Set the failure links, breadth first so the links of shallower nodes are set first
+        """
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._longest[child] = max(self._longest[child], self._longest[self._fail[child]])
+                queue.append(child)
+
+    def longest_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        Iterate over the (start, end) of the longest pattern occurrence ending at each position of the text,
+        in order of the end position. Shorter occurrences ending at the same position are within it
+        """
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._longest[node]:
+                yield end - self._longest[node], end
+
+def normalize_whitespace(text: str) -> Tuple[str, List[int]]:
+    """
+    Collapse each run of whitespace into a single space
+    Returns the normalized text, and the position in the original text of each normalized character
+    """
+    normalized = []
+    positions = []
+    previous_space = False
+    for pos, char in enumerate(text):
+        is_space = char.isspace()
+        if is_space and previous_space:
+            continue
+        normalized.append(' ' if is_space else char)
+        positions.append(pos)
+        previous_space = is_space
+    return ''.join(normalized), positions
+
+def compressed_sentences(compressed_text: str) -> List[str]:
+    """
+    Split the compressed text into the extracted sentences, without numbering, quotations or extra whitespace
+    """
+    sentences = []
+    for sent in compressed_text.split('\n'):
+        sent = NUMBERING_PATTERN.sub('', sent.strip())
+        # Remove quotations around the sentence, if applicable
+        sent = WHITESPACE_PATTERN.sub(' ', sent.strip('"')).strip()
+        if sent:
+            sentences.append(sent)
+    return sentences
+
+def merge_spans(spans: Iterator[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Merge overlapping (start, end) spans, given in order of their end
+    """
+    merged = []
+    for start, end in spans:
+        while merged and merged[-1][1] > start:
+            start = min(start, merged.pop()[0])
+        merged.append((start, end))
+    return merged
+
+def add_italics(text: str, out: List[str]):
+    """
+    Append the text to out, with italics markings around every line of the text
+    Each run of characters without a newline or '*' is marked from its first to its last word character
+    """
+    run_start = 0
+    for pos in range(len(text) + 1):
+        if pos < len(text) and text[pos] not in '\n*':
+            continue
+        run = text[run_start:pos]
+        word_positions = [i for i, char in enumerate(run) if char.isalnum() or char == '_']
+        if word_positions and word_positions[-1] - word_positions[0] >= 2:
+            first, last = word_positions[0], word_positions[-1] + 1
+            out.append(f"{run[:first]}*{run[first:last]}*{run[last:]}")
+        else:
+            out.append(run)
+        if pos < len(text):
+            out.append(text[pos])
+        run_start = pos + 1
+
+def highlight_compressed_sections(original_text: str, compressed_text: str) -> str:
+    """
+    Places italics markings around the sections of the original text that are referenced in the compressed text
+    - original_text: the original text
+    - compressed_text: a response from an LLM asked to extract relevant sections of the original text
+    """
+    sentences = compressed_sentences(compressed_text)
+    if not sentences:
+        return original_text
+
+    normalized, positions = normalize_whitespace(original_text)
+    spans = merge_spans(AhoCorasick(sentences).longest_matches(normalized))
+
+    out = []
+    last = 0
+    for start, end in spans:
+        # Map the span back to the original text
+        start, end = positions[start], positions[end - 1] + 1
+        out.append(original_text[last:start])
+        add_italics(original_text[start:end], out)
+        last = end
+    out.append(original_text[last:])
+    return ''.join(out)
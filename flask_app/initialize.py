@@ -1,7 +1,9 @@
 import os
+import threading
 import psycopg2
 from pgvector.psycopg2 import register_vector
 from aws_helpers.param_manager import get_param_manager
+from aws_helpers.db_pool import ConnectionPool
 from aws_helpers.s3_tools import download_s3_directory
 import logging
 
@@ -22,8 +24,11 @@ except Exception as e:
     logger.error("Error initializing parameter manager: %s", e)
     raise e
 
-# Set variable to represent connection to RDS
-connection = None
+# Connection pool sizes, the app runs a few threads per worker
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 8
+# Max seconds to wait for a free connection
+POOL_TIMEOUT = 30
 
 def download_all_dirs():
     """
@@ -68,33 +73,50 @@ connection_params = {
 # Create the connection string
 connection_string = " ".join([f"{key}={value}" for key, value in connection_params.items()])
 
-try:
-    # Connect to PostgreSQL database using connection string
-    connection = psycopg2.connect(connection_string)
-    cur = connection.cursor()
-    logger.info("Connected to RDS instance!")
+def close_pool():
+    """
+    Close the connection pool created by a previous load of this module
+    (the module is reloaded by the /initialize endpoint)
+    """
+    previous_pool = globals().get('pool')
+    if previous_pool is not None:
+        previous_pool.close()
+        logger.info("Closed previous connection pool.")
+
+close_pool()
+
+def configure_connection(conn):
+    """
+    Set up a new physical connection to RDS: register the pgvector types, and enable
+    iterative HNSW index scans so filtered KNN queries still return the requested number of rows
+    (iterative scans need pgvector 0.8.0 or later, older versions filter the first ef_search candidates only)
+    """
+    register_vector(conn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET hnsw.iterative_scan = relaxed_order")
+    except psycopg2.Error as e:
+        logger.warning("Could not enable iterative index scans: %s", e)
+        conn.rollback()
 
-    # Register pgvector extension
-    register_vector(connection)
-    logger.info("Registered pgvector extension.")
+# Shared pool of connections for the worker's threads
+# configure_connection runs once for each new physical connection
+pool = None
+pool_lock = threading.Lock()
+try:
+    pool = ConnectionPool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, on_connect=configure_connection, dsn=connection_string)
+    logger.info("Connected to RDS instance and registered pgvector extension!")
 except Exception as e:
     logger.error("Error connecting to RDS instance: %s", e)
-    connection.rollback()
-finally:
-    if cur:
-        cur.close()
-    if connection:
-        connection.close()
-    logger.info("Connection closed.")
 
-def return_connection():
-    global connection
-    if connection is None or connection.closed:
-        try:
-            connection = psycopg2.connect(connection_string)
-            register_vector(connection)
+def get_connection(timeout: float = POOL_TIMEOUT):
+    """
+    Return a context manager that checks out a pooled connection to RDS
+    and returns it to the pool afterwards
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, on_connect=configure_connection, dsn=connection_string)
             logger.info("Reconnected to RDS instance and registered pgvector extension.")
-        except Exception as e:
-            logger.error("Error reconnecting to RDS instance: %s", e)
-            connection = None
-    return connection
\ No newline at end of file
+    return pool.connection(timeout)
@@ -1,17 +1,20 @@
 from langchain.docstore.document import Document
 from langchain.retrievers.document_compressors import LLMChainExtractor
-import regex as re
 from typing import List, Dict, Tuple
 from retrievers import Retriever, load_retriever
 import copy 
 import json
 import os
 from langchain.chains.question_answering import load_qa_chain
+from langchain_core.prompts import format_document
 import llms
-from documents import load_graph, get_split_sib_ids
+from documents import load_graph, SplitChainIndex
 import prompts
 from aws_helpers.param_manager import get_param_manager
 from aws_helpers.s3_tools import download_s3_directory
+from metrics import timed
+from retrieval_policy import AdaptiveK
+from highlighter import highlight_compressed_sections
 
 # If process is running locally, activate dev mode
 DEV_MODE = 'MODE' in os.environ and os.environ.get('MODE') == 'dev'
@@ -21,6 +24,15 @@ GRAPH_FILEPATH = os.path.join('data','documents','website_graph.txt')
 ### CONSTANTS
 MIN_DOC_LENGTH = 100 # Remove documents below a certain character length - helps with some LLM hallucinations
 MAX_TOKENS = 750 # Max input tokens
+# Bounds and cutoffs of the adaptive number of retrieved documents, see retrieval_policy.py
+ADAPTIVE_MIN_K = 1
+ADAPTIVE_MAX_K = 6
+ADAPTIVE_MIN_SIMILARITY = 0.3
+ADAPTIVE_MAX_RELATIVE_DROP = 0.25
+
+### Globals
+retrieval_policy = AdaptiveK(min_k=ADAPTIVE_MIN_K, max_k=ADAPTIVE_MAX_K, min_similarity=ADAPTIVE_MIN_SIMILARITY,
+                             max_relative_drop=ADAPTIVE_MAX_RELATIVE_DROP)
 
 ### LOAD AWS CONFIG
 param_manager = get_param_manager()
@@ -63,6 +75,7 @@ def download_all_dirs(retriever: str):
 download_all_dirs(retriever_config['RETRIEVER_NAME'])
 
 graph = load_graph(GRAPH_FILEPATH)
+split_chains = SplitChainIndex(graph)
 
 data_source_annotations = read_text(os.path.join('static','data_source_annotations.json'), as_json=True)
 
@@ -111,52 +124,16 @@ def get_related_links_from_compressed(docs, compressed_docs):
 def combine_sib_docs(retriever: Retriever, docs: List[Document]) -> List[Document]:
     """
     For each document, combine its context with all of its immediate siblings
+    The siblings of all documents are fetched in a single lookup
     """
-    for doc in docs:
-        sib_ids = get_split_sib_ids(graph, doc.metadata['doc_id'])
-        sib_docs = retriever.docs_from_ids(sib_ids)
-        combined_content = ' '.join([sib_doc.page_content for sib_doc in sib_docs])
+    chains = [split_chains.chain(int(doc.metadata['doc_id'])) for doc in docs]
+    sib_ids = list(dict.fromkeys(sib_id for chain in chains for sib_id in chain))
+    sib_docs = {int(sib_doc.metadata['doc_id']): sib_doc for sib_doc in retriever.docs_from_ids(sib_ids)}
+    for doc, chain in zip(docs, chains):
+        combined_content = ' '.join([sib_docs[sib_id].page_content for sib_id in chain if sib_id in sib_docs])
         doc.page_content = combined_content
         doc.metadata['titles'] = doc.metadata['titles'][:-1]
 
-def highlight_compressed_sections(original_text: str, compressed_text: str):
-    """
-    Places italics markings around the sections of the original text that are referenced in the compressed text
-    - original_text: the original text
-    - compressed_text: a response from an LLM asked to extract relevant sections of the original text
-    """
-    highlighted_text = original_text
-    
-    compressed_sentences = compressed_text.split('\n')
-    
-    # Vicuna likes to add numbers to each returned sentence, this removes t he numbers
-    compressed_sentences = [re.sub('\d(\.)\s','',sent.strip()) for sent in compressed_sentences]
-    
-    for sent in compressed_sentences:
-        if len(sent) == 0: continue 
-        
-        # Remove quotations around the sentence, if applicable
-        if sent[0] == '"': sent = sent[1:]
-        if sent[-1] == '"': sent = sent[:-1]
-        
-        # Vicuna likes to add numbers to each returned sentence, this removes the numbers
-        sent = re.sub('\d(\.)\s','',sent)
-        
-        if match := re.search(sent, original_text):
-            # Add italics markings as the indicator to highlight
-            highlighted_section = add_italics(match.group())
-            highlighted_text = highlighted_text.replace(match.group(), highlighted_section)
-            
-    return highlighted_text
-
-def add_italics(text):
-    """
-    Add italics markings around every line of the text
-    """
-    for match in re.finditer('[\w\d][^\n\*]+[\w\d]',text):
-        text = text.replace(match.group(),f"*{match.group()}*")
-    return text
-
 def doc_display_title(doc: Document):
     """
     Return a display formatted title for a document
@@ -225,22 +202,40 @@ def llm_filter_docs(docs: List[Document], program_info: Dict, topic: str, query:
     else:
         return filtered
 
+def doc_prompt_tokens(doc: Document) -> int:
+    """
+    Return the number of tokens of the document as formatted in the combine documents prompt
+    The count is cached in the document's metadata, and recounted if the page content changes
+    """
+    content_hash = hash(doc.page_content)
+    cached = doc.metadata.get('prompt_tokens')
+    if cached is None or cached[0] != content_hash:
+        text = format_document(doc, combine_documents_chain.document_prompt)
+        cached = (content_hash, combine_documents_chain.llm_chain.llm.get_num_tokens(text))
+        doc.metadata['prompt_tokens'] = cached
+    return cached[1]
+
 def llm_combined_answer(input_docs: List[Document], removed_docs: List[Document], llm_query:str) -> str:
     """
     Generate an LLM response for the combined set of documents.
     If the documents are too long, removes documents and adds them to the removed_docs list
+    The prompt length is the tokens of the prompt without documents, plus the tokens of each document
+    and separator, so documents are only tokenized once
     """
+    separator_tokens = combine_documents_chain.llm_chain.llm.get_num_tokens(combine_documents_chain.document_separator)
     while len(input_docs) > 0:
         cutoff_docs = []
         
-        while combine_documents_chain.prompt_length(input_docs, question=llm_query) > MAX_TOKENS:
+        doc_tokens = [doc_prompt_tokens(doc) for doc in input_docs]
+        prompt_length = combine_documents_chain.prompt_length([], question=llm_query) + sum(doc_tokens) \
+                        + separator_tokens * (len(input_docs) - 1)
+        while prompt_length > MAX_TOKENS and len(input_docs) > 0:
             # Remove documents if the resulting input would be too long
-            print(combine_documents_chain.prompt_length(input_docs, question=llm_query))
-            last_doc = input_docs[-1]
-            cutoff_docs.append(last_doc)
-            input_docs.remove(last_doc)
+            cutoff_docs.append(input_docs.pop())
+            prompt_length -= doc_tokens.pop() + (separator_tokens if len(input_docs) > 0 else 0)
         
-        combined_answer = combine_documents_chain.run(input_documents=input_docs, question=llm_query)
+        with timed('generation'):
+            combined_answer = combine_documents_chain.run(input_documents=input_docs, question=llm_query)
         if not is_empty_answer(combined_answer):
             removed_docs.extend(cutoff_docs)
             return combined_answer
@@ -257,19 +252,12 @@ def is_empty_answer(answer: str) -> bool:
     """            
     return answer is None or len(answer) == 0 or "I do not have the information to answer" in answer 
     
-def backoff_retrieval(retriever: Retriever, program_info: Dict, topic: str, query:str, k:int = 5, threshold = 0, 
-                      do_filter: bool = False) -> List[Document]:
+def backoff_levels(program_info: Dict) -> List[Dict]:
+    """
+    Return the levels of a backoff retrieval, from the most to the least specific.
+    Each level is a dict of its 'program_info', the metadata 'filter' and the 'nonfiltered_program_info'
+    to search with, and the 'removed_keys' of the program info removed so far
     """
-    Perform a multistep retrieval where, if no documents are returned for the full
-    program_info filter, filters are progressively removed and attempts retrieval again.
-    - program_info: Dict of values describe the faculty, program, specialization, and/or year
-    - topic: Topic of the question
-    - query: The text query
-    - k: number of documents to return
-    - threshold: relevance threshold, all returned documents must surpass the threshold
-                 the threshold range depends on the scoring function of the chosen retriever
-    - do_filter: If true, performs an LLM filter step on returned documents
-    """ 
     backoff_order = [['specialization','year'],['program','faculty']] 
     # ^ order of context elements to remove
     metadata_filter_keys = ['program','faculty']
@@ -277,14 +265,18 @@ def backoff_retrieval(retriever: Retriever, program_info: Dict, topic: str, quer
     metadata_filter_when_empty = ['specialization','program','faculty'] 
     # ^ these keys will be included in the metadata filter when the value is empty
     
-    answer = ""
     program_info_copy = copy.copy(program_info) # copy the dict since elements will be popped
-    docs = []
-    removed_docs = []
-    
-    backoff_index = 0
     removed_keys = []
-    while is_empty_answer(answer):
+    levels = []
+    for backoff_keys in [[]] + backoff_order:
+        # Only back off to a new level if there is a key to remove from the program info
+        keys = [key for key in backoff_keys if key in program_info_copy and program_info_copy[key] != '']
+        if backoff_keys and not keys:
+            continue
+        for key in keys:
+            program_info_copy[key] = ''
+            removed_keys.append(key)
+        
         # Prepare the metadata filter
         filter = {}
         nonfiltered_program_info = copy.copy(program_info_copy)
@@ -294,21 +286,61 @@ def backoff_retrieval(retriever: Retriever, program_info: Dict, topic: str, quer
                 filter[key] = val
                 nonfiltered_program_info.pop(key)
         
-        # Perform search
-        docs = retriever.semantic_search(filter, nonfiltered_program_info, topic, query, k=k, threshold=threshold)
+        levels.append({'program_info': copy.copy(program_info_copy), 'filter': filter,
+                       'nonfiltered_program_info': nonfiltered_program_info, 'removed_keys': copy.copy(removed_keys)})
+    return levels
+
+def backoff_retrieval(retriever: Retriever, program_info: Dict, topic: str, query:str, k:int = 5, threshold = 0, 
+                      do_filter: bool = False, policy: AdaptiveK = None) -> List[Document]:
+    """
+    Perform a multistep retrieval where, if no answer is found with the documents for the full
+    program_info filter, filters are progressively removed and an answer is attempted again.
+    The documents of every level are retrieved together before any LLM call, so the search takes a single
+    round trip and levels without documents are skipped without an LLM call.
+    - program_info: Dict of values describe the faculty, program, specialization, and/or year
+    - topic: Topic of the question
+    - query: The text query
+    - k: number of documents to return
+    - threshold: relevance threshold, all returned documents must surpass the threshold
+                 the threshold range depends on the scoring function of the chosen retriever
+    - do_filter: If true, performs an LLM filter step on returned documents
+    - policy: If provided, fetches policy.max_k documents and keeps as many as the policy selects
+              from their scores, instead of k documents
+    """ 
+    levels = backoff_levels(program_info)
+    
+    # Perform search
+    with timed('knn_query'):
+        level_docs = retriever.multi_level_search([(level['filter'], level['nonfiltered_program_info']) for level in levels], 
+                                                  topic, query, k=policy.max_k if policy else k, threshold=threshold)
+    
+    answer = ""
+    docs = []
+    removed_docs = []
+    removed_keys = []
+    for level, docs in zip(levels, level_docs):
+        removed_keys = level['removed_keys']
         
         # Prefilter documents that are too short
         # Some LLMs will hallucinate if the document content is empty
         docs = [doc for doc in docs if len(doc.page_content) >= MIN_DOC_LENGTH]
+        if len(docs) == 0:
+            continue
+        
+        if policy:
+            # Cut the documents that score too low compared to the floor or the best hit
+            docs, cut_docs = policy.split(docs, [doc.metadata['score'] for doc in docs])
+            removed_docs += cut_docs
         
         # Generate an intermediate answer
         docs_for_llms(docs)
         if do_filter: 
-            docs, removed = llm_filter_docs(docs, nonfiltered_program_info, topic, query, return_removed=True)
+            with timed('llm_filter'):
+                docs, removed = llm_filter_docs(docs, level['nonfiltered_program_info'], topic, query, return_removed=True)
             removed_docs += removed
         
         if len(docs) > 0:   
-            llm_query = prompts.llm_query(program_info_copy, topic, query)
+            llm_query = prompts.llm_query(level['program_info'], topic, query)
             answer = llm_combined_answer(docs, removed_docs, llm_query)
         
             if is_empty_answer(answer): 
@@ -318,24 +350,8 @@ def backoff_retrieval(retriever: Retriever, program_info: Dict, topic: str, quer
             else:
                 # Generated an answer, break loop
                 break
-        
-        has_key = False
-        # Find the next key(s) that can be removed from the program info
-        while not has_key and backoff_index < len(backoff_order):
-            for key in backoff_order[backoff_index]:
-                if key in program_info_copy and program_info_copy[key] != '':
-                    # Remove the key from the filter and redo search
-                    program_info_copy[key] = ''
-                    has_key = True
-                    removed_keys.append(key)
-                    
-            backoff_index += 1
-        
-        if not has_key:
-            # No key left to remove, break loop
-            break
     
-    if len(docs) > k:
+    if not policy and len(docs) > k:
         # If there are extra relevant docs beyond k, move them
         # to removed docs
         removed_docs = docs[k:] + removed_docs
@@ -357,7 +373,8 @@ default_config = {
     'compress': False, 
     'generate_by_document': False,
     'generate_combined': use_llm, 
-    'k': 3
+    'k': 3,
+    'adaptive_k': True
 }
 
 def consolidate_config(config: Dict, default_config: Dict = default_config):
@@ -387,6 +404,7 @@ async def run_chain(program_info: Dict, topic: str, query: str, config: Dict):
         - generate_by_document: If true, generates a response for each final document
         - generate_combined: If true, generates a reponse using the combined documents
         - k: Number of documents to retrieve
+        - adaptive_k: If true, chooses the number of documents to retrieve from their scores instead of k
     """
     config = consolidate_config(config)
     main_response: str = None
@@ -395,7 +413,8 @@ async def run_chain(program_info: Dict, topic: str, query: str, config: Dict):
     
     # Spell correct the query if the option is turned on
     if config['spell_correct']:
-        corrected_query = spell_correct_chain.run(text=query,stop=[">>> end correction"])
+        with timed('spell_correct'):
+            corrected_query = spell_correct_chain.run(text=query,stop=[">>> end correction"])
         if query.lower() != corrected_query.lower(): alerts.append(f'Used spell/grammar corrected query: {corrected_query}')
         query = corrected_query
         
@@ -409,21 +428,26 @@ async def run_chain(program_info: Dict, topic: str, query: str, config: Dict):
     else:
         # Peform retrieval
         result, ignored_keys, removed_docs, main_response = backoff_retrieval(retriever, program_info, topic, query, 
-                                                                              k=config['k'], do_filter=config['do_filter'], threshold=0.1)
+                                                                              k=config['k'], do_filter=config['do_filter'], threshold=0.1,
+                                                                              policy=retrieval_policy if config['adaptive_k'] else None)
         docs += result
 
-    if config['combine_with_sibs']: combine_sib_docs(retriever, docs)
+    if config['combine_with_sibs']: 
+        with timed('combine_siblings'):
+            combine_sib_docs(retriever, docs)
 
     # Perform compression step if the option is turned on
     compressed_docs = None
     if config['compress']: 
-        compressed_docs = compressor.compress_documents(docs, llm_query)
+        with timed('compression'):
+            compressed_docs = compressor.compress_documents(docs, llm_query)
         get_related_links_from_compressed(docs, compressed_docs)
 
     for doc in docs:    
         # Generate a response from this document onlys, if the option is turned on
         if config['generate_by_document']:
-            generated = combine_documents_chain.run(input_documents=[doc], question=llm_query)
+            with timed('generation'):
+                generated = combine_documents_chain.run(input_documents=[doc], question=llm_query)
             doc.metadata['generated_response'] = generated
     
         if config['compress']:
@@ -0,0 +1,189 @@
+"""
+Minimal in-process metrics, exported in the Prometheus text format by the /metrics endpoint
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+### Globals
+# Every metric registers itself here, in order of creation
+registry = []
+
+def format_labels(label_names: Tuple[str], label_values: Tuple, extra: Dict = {}) -> str:
+    """
+    Format label names and values as a Prometheus label set, eg. {stage="embedding"}
+    """
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric():
+    """
+    Base class of a metric with a fixed set of label names
+    """
+    type: str = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _label_values(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        """
+        Return the lines of the metric's samples
+        """
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        return '\n'.join(lines + self.samples())
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}" for key, value in values.items()]
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, eg. the number of requests in flight
+    """
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Increment the gauge for the duration of the block
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class CallbackGauge(Metric):
+    """
+    Gauge whose values are read from a callback when the metrics are rendered
+    The callback returns a dict of label values tuple -> value
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, callback: Callable[[], Dict[Tuple, float]], label_names: Tuple[str] = ()):
+        super().__init__(name, description, label_names)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {e}")
+            return []
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}" for key, value in values.items()]
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted in cumulative buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str] = (), buckets: Tuple[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {} # label values -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the block, in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        lines = []
+        for key, (bucket_counts, total, count) in values.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = format_labels(self.label_names, key, {'le': format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render() -> str:
+    """
+    Render all registered metrics in the Prometheus text exposition format
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+### Metrics of the answer pipeline
+stage_seconds = Histogram('answer_stage_duration_seconds', 'Duration of each stage of the answer pipeline', ('stage',))
+request_seconds = Histogram('answer_request_duration_seconds', 'Duration of requests to the answer endpoints', ('endpoint',))
+requests_in_flight = Gauge('answer_requests_in_flight', 'Number of requests currently being answered', ('endpoint',))
+cache_lookups = Counter('answer_cache_lookups_total', 'Lookups of cached answers, by cache and hit or miss', ('cache', 'result'))
+model_routes = Counter('model_routes_total', 'Generation models chosen by the model router, by routing mode and reason', ('mode', 'model', 'reason'))
+
+def timed(stage: str):
+    """
+    Context manager that records the duration of a stage of the answer pipeline
+    eg. with timed('embedding'): ...
+    """
+    return stage_seconds.time(stage=stage)
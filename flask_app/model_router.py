@@ -0,0 +1,96 @@
+"""
+Routing of questions between the configured generation model and a smaller, faster model.
+The route is chosen per question from signals that are known once the documents are retrieved:
+the similarity of the best document, how far it stands out from the next one, the number of
+tokens of the generation prompt and the length of the question. Questions with one clearly
+matching document and a short prompt go to the small model, everything else to the default model.
+Modes:
+- 'off': always use the default model
+- 'shadow': always use the default model, but log and count the route that would have been chosen
+- 'active': use the chosen route
+"""
+
+from typing import Dict, List, Tuple
+import metrics
+
+ROUTING_MODES = ('off', 'shadow', 'active')
+
+class ModelRouter():
+    """
+    Chooses the generation model of a question
+    """
+
+    def __init__(self, default_model: str, small_model: str, mode: str = 'off', min_top_similarity: float = 0.6,
+                 min_score_spread: float = 0.05, max_prompt_tokens: int = 3000, max_question_chars: int = 400):
+        """
+        - default_model: model used unless the question is routed to the small model
+        - small_model: model for straightforward questions
+        - mode: one of ROUTING_MODES
+        - min_top_similarity: min cosine similarity of the best document for the small model
+        - min_score_spread: min similarity gap between the best and second best document for the small model,
+                            so questions that need several documents combined go to the default model
+        - max_prompt_tokens: max tokens of the generation prompt for the small model
+        - max_question_chars: max characters of the question (including its program context) for the small model
+        """
+        if mode not in ROUTING_MODES:
+            raise ValueError(f"Unsupported model routing mode '{mode}', choices are {ROUTING_MODES}")
+        self.default_model = default_model
+        self.small_model = small_model
+        self.mode = mode
+        self.min_top_similarity = min_top_similarity
+        self.min_score_spread = min_score_spread
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_question_chars = max_question_chars
+
+    @staticmethod
+    def signals(question: str, docs: List[Dict], prompt_tokens: int) -> Dict:
+        """
+        Compute the routing signals of a question
+        - docs: the documents of the generation prompt, sorted by 'score' (cosine distance)
+        - prompt_tokens: number of tokens of the generation prompt, including the documents
+        """
+        similarities = [1 - doc['score'] for doc in docs]
+        top = similarities[0] if similarities else 0
+        return {"top_similarity": top,
+                "score_spread": top - similarities[1] if len(similarities) > 1 else top,
+                "prompt_tokens": prompt_tokens,
+                "question_chars": len(question)}
+
+    def choose(self, signals: Dict) -> Tuple[str, str]:
+        """
+        Return the model for the signals, and the reason it was chosen
+        """
+        if signals["top_similarity"] < self.min_top_similarity:
+            return self.default_model, 'weak_match'
+        if signals["score_spread"] < self.min_score_spread:
+            return self.default_model, 'several_matches'
+        if signals["prompt_tokens"] > self.max_prompt_tokens:
+            return self.default_model, 'long_prompt'
+        if signals["question_chars"] > self.max_question_chars:
+            return self.default_model, 'long_question'
+        return self.small_model, 'straightforward'
+
+    def route(self, question: str, docs: List[Dict], prompt_tokens: int) -> str:
+        """
+        Return the model to answer the question with, for the routing mode
+        """
+        if self.mode == 'off':
+            return self.default_model
+
+        signals = self.signals(question, docs, prompt_tokens)
+        model, reason = self.choose(signals)
+        metrics.model_routes.inc(mode=self.mode, model=model, reason=reason)
+        if self.mode == 'shadow':
+            print(f"Model router would choose {model} ({reason}): {signals}")
+            return self.default_model
+        return model
+
+    def policy_key(self) -> str:
+        """
+        Identify the routing policy, for cache keys of generated answers
+        Answers only depend on the policy when routing is active
+        """
+        if self.mode != 'active':
+            return 'default'
+        return ':'.join(str(part) for part in (self.small_model, self.min_top_similarity, self.min_score_spread,
+                                               self.max_prompt_tokens, self.max_question_chars))
@@ -18,6 +18,8 @@ import os
 from typing import List
 from importlib import reload 
 from aws_helpers.rds_tools import execute_and_fetch
+import metrics
+from metrics import timed
 
 ### Constants
 FACULTIES_PATH = os.path.join('data','documents','faculties.json')
@@ -98,16 +100,19 @@ async def answer():
     config = {
         'start_doc': start_doc
     }
-    docs, main_response, alerts, removed_docs = await langchain_inference_module.run_chain(program_info,topic,question,config)
-    
-    # Log the question
-    context_str = ' : '.join([value for value in list(program_info.values()) + [topic] if len(value) > 0])
-    log_question(question, context_str, main_response, [doc.metadata['doc_id'] for doc in docs])
-    
-    # Render the results
-    return render_template('old_ans.html',title=app_title,question=question,context=context_str,docs=docs,
-                           form=request.form.to_dict(), main_response=main_response, alerts=alerts,
-                           removed_docs=removed_docs, last_updated=last_updated_time)
+    with metrics.requests_in_flight.track(endpoint='/answer'), metrics.request_seconds.time(endpoint='/answer'):
+        docs, main_response, alerts, removed_docs = await langchain_inference_module.run_chain(program_info,topic,question,config)
+        
+        # Log the question
+        context_str = ' : '.join([value for value in list(program_info.values()) + [topic] if len(value) > 0])
+        with timed('logging'):
+            log_question(question, context_str, main_response, [doc.metadata['doc_id'] for doc in docs])
+        
+        # Render the results
+        with timed('render'):
+            return render_template('old_ans.html',title=app_title,question=question,context=context_str,docs=docs,
+                                   form=request.form.to_dict(), main_response=main_response, alerts=alerts,
+                                   removed_docs=removed_docs, last_updated=last_updated_time)
 
 @application.route('/feedback', methods=['POST'])
 async def feedback():
@@ -154,6 +159,13 @@ def initialize():
 def health():
     return Response("OK", status=200)
 
+@application.route('/metrics')
+def metrics_endpoint():
+    """
+    Export the pipeline latency metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 def setup():
     """
     Setup to perform on load, before initialization
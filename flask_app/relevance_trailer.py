@@ -0,0 +1,130 @@
+"""
+Inline relevance judgments of the generation prompt's documents.
+The model is asked to follow its answer with a trailer of one relevance explanation per document:
+
+    RELEVANCE:
+    Document 1: <short explanation of whether the document is relevant to the question or not>
+    Document 2: ...
+
+so the answer and the relevance explanations take a single LLM call.
+The parser tolerates markdown decoration and multi-line explanations, and reports the documents
+without a judgment so the caller can fall back to checking them separately.
+A marker line is only taken as the start of the trailer if judgments follow it, otherwise it is part of the answer.
+"""
+
+import re
+from typing import Dict, Tuple
+
+RELEVANCE_MARKER = "RELEVANCE:"
+
+# The marker line, possibly decorated with markdown, eg. '**RELEVANCE:**' or '### RELEVANCE:'
+MARKER_PATTERN = re.compile(r'^[\s#*_>-]*RELEVANCE[\s*_]*:[\s*_]*$')
+# A judgment line, eg. 'Document 2: ...', '- **Document 2**: ...' or '[2] ...'
+JUDGMENT_PATTERN = re.compile(r'^[\s*_>-]*(?:document\s*(\d+)|\[(\d+)\])[\s*_]*[:.)\-–]?[\s*_]*(.*)$', re.IGNORECASE)
+# Characters that may decorate the marker line, ignored when checking if a partial line may be the marker
+DECORATION = ' \t#*_>-'
+
+def trailer_instructions() -> str:
+    """
+    Instructions for the generation prompt, asking for the relevance trailer
+    """
+    return (f"After your answer, write a line containing only '{RELEVANCE_MARKER}', followed by one line for each "
+            f"document in the format 'Document <number>: <short explanation if the document is relevant to the question or not>'.")
+
+def parse_judgments(trailer: str) -> Dict[int, str]:
+    """
+    Parse the judgment lines of a trailer, as a dict of document number (1-indexed) -> explanation
+    Lines that don't start a judgment continue the previous one
+    """
+    judgments = {}
+    current = None
+    for line in trailer.splitlines():
+        match = JUDGMENT_PATTERN.match(line)
+        if match:
+            current = int(match.group(1) or match.group(2))
+            judgments[current] = match.group(3).strip()
+        elif current is not None and line.strip():
+            judgments[current] = (judgments[current] + ' ' + line.strip()).strip()
+    return {number: explanation for number, explanation in judgments.items() if explanation}
+
+def split_relevance_trailer(text: str) -> Tuple[str, Dict[int, str]]:
+    """
+    Split the generated text into the answer and the judgments of its relevance trailer
+    If there is no trailer, the whole text is the answer and there are no judgments
+    """
+    lines = text.splitlines(keepends=True)
+    # The last marker line followed by judgments is used, in case the answer itself has a marker line
+    for i in range(len(lines) - 1, -1, -1):
+        if MARKER_PATTERN.match(lines[i]):
+            judgments = parse_judgments(''.join(lines[i + 1:]))
+            if judgments:
+                return ''.join(lines[:i]).rstrip(), judgments
+    return text.strip(), {}
+
+class TrailerFilter():
+    """
+    Hides the relevance trailer from a streamed answer.
+    Text is passed through as it arrives, except for a partial line that could still be the marker line,
+    which is held back until the line is complete, and a marker line, which is held back until
+    the next non-blank line shows whether it starts the trailer (a judgment) or not
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self._pending = ''
+        self._held = '' # A marker line and the blank lines after it
+        self._in_trailer = False
+
+    def _may_be_marker(self, line: str) -> bool:
+        stripped = line.strip(DECORATION)
+        return RELEVANCE_MARKER.startswith(stripped) or MARKER_PATTERN.match(line) is not None
+
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk of the generated text, returning the text that can be shown
+        """
+        self.chunks.append(chunk)
+        if self._in_trailer:
+            return ''
+
+        self._pending += chunk
+        shown = ''
+        while True:
+            newline = self._pending.find('\n')
+            if newline == -1:
+                break
+            line = self._pending[:newline + 1]
+            self._pending = self._pending[newline + 1:]
+            if self._held and JUDGMENT_PATTERN.match(line):
+                self._in_trailer = True
+                self._pending = ''
+                return shown
+            if self._held and not line.strip():
+                self._held += line
+            elif MARKER_PATTERN.match(line):
+                shown += self._held
+                self._held = line
+            else:
+                shown += self._held + line
+                self._held = ''
+
+        if not self._held and not self._may_be_marker(self._pending):
+            shown += self._pending
+            self._pending = ''
+        return shown
+
+    def finish(self) -> Tuple[str, Dict[int, str]]:
+        """
+        Return the answer and the judgments, once the generation is done
+        Text held back at the end is part of the answer if it is not the marker
+        """
+        return split_relevance_trailer(''.join(self.chunks))
+
+    def remainder(self) -> str:
+        """
+        Return the held back text that should still be shown once the generation is done
+        A held back marker line is shown, since no judgments followed it
+        """
+        if self._in_trailer:
+            return ''
+        return self._held + self._pending
@@ -0,0 +1,50 @@
+"""
+Adaptive number of retrieved documents.
+Retrieval over-fetches up to max_k documents, and keeps documents in order of similarity until one is
+below an absolute similarity floor, or drops too far below the best hit. So questions with one clear
+match send fewer documents to the LLM, and questions with many similar matches get more.
+"""
+
+from typing import List, Sequence, Tuple
+
+class AdaptiveK():
+    """
+    Chooses how many of the retrieved documents to keep, from their similarity scores
+    Similarities are cosine similarities (1 - cosine distance), larger is more similar
+    """
+
+    def __init__(self, min_k: int = 1, max_k: int = 8, min_similarity: float = 0.3, max_relative_drop: float = 0.25):
+        """
+        - min_k: min number of documents to keep, regardless of their scores
+        - max_k: max number of documents to keep, and number of documents to fetch
+        - min_similarity: documents below this similarity are cut
+        - max_relative_drop: documents whose similarity is lower than the best hit's by more than this
+                             fraction of the best hit's similarity are cut
+        """
+        if not 1 <= min_k <= max_k:
+            raise ValueError(f"Expected 1 <= min_k <= max_k, got min_k={min_k} and max_k={max_k}")
+        self.min_k = min_k
+        self.max_k = max_k
+        self.min_similarity = min_similarity
+        self.max_relative_drop = max_relative_drop
+
+    def select(self, similarities: Sequence[float]) -> int:
+        """
+        Return the number of documents to keep
+        - similarities: similarities of the documents, sorted in descending order
+        """
+        if len(similarities) == 0:
+            return 0
+        floor = max(self.min_similarity, similarities[0] * (1 - self.max_relative_drop))
+        keep = min(len(similarities), self.max_k)
+        for i in range(self.min_k, keep):
+            if similarities[i] < floor:
+                return i
+        return keep
+
+    def split(self, docs: List, similarities: Sequence[float]) -> Tuple[List, List]:
+        """
+        Split documents sorted by similarity into the kept documents and the cut documents
+        """
+        keep = self.select(similarities)
+        return docs[:keep], docs[keep:]
@@ -40,9 +40,21 @@ class Retriever(ABC):
         - k: number of documents to return
         - threshold: relevance threshold, all returned documents must surpass the threshold
                      the threshold range depends on the scoring function of the chosen retriever
+        Returned documents are sorted by relevance, with their relevance score in metadata['score']
         """
         pass
     
+    def multi_level_search(self, levels: List[Tuple[Dict,Dict]], topic: str, query: str, k = 5, threshold = 0) -> List[List[Document]]:
+        """
+        Return the documents from similarity search for each level of a backoff retrieval
+        - levels: list of (filter, program_info) tuples, as passed to semantic_search
+        Other arguments are as in semantic_search
+        Retrievers that can search all levels at once should override this,
+        by default each level is searched separately
+        """
+        return [self.semantic_search(filter, program_info, topic, query, k=k, threshold=threshold) 
+                for filter, program_info in levels]
+    
     @abstractmethod
     def docs_from_ids(self, doc_ids: List[int]) -> List[Document]:
         """
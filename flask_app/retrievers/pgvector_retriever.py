@@ -2,6 +2,7 @@ from langchain.vectorstores.base import VectorStoreRetriever
 from langchain.schema import Document
 from langchain.vectorstores.pgvector import PGVector, DistanceStrategy
 from typing import List, Dict, Tuple, Callable, Optional
+import sqlalchemy
 import os
 import copy
 import ast
@@ -39,9 +40,7 @@ class MyPGVectorRetriever(PGVector):
         Add kwargs to support similarity search with threshold, since the threshold
         is a kwarg used by functions upstream
         """
-        result = super().similarity_search_with_score_by_vector(embedding,k,filter)
-        print([score for doc, score in result])
-        return result
+        return super().similarity_search_with_score_by_vector(embedding,k,filter)
     
     def _select_relevance_score_fn(self) -> Callable[[float], float]:
         """
@@ -99,6 +98,9 @@ class PGVectorRetriever(Retriever):
         db = MyPGVectorRetriever.from_existing_index(embeddings_model, index_config['name'], connection_string=connection_string)
         
         self.retriever = VectorStoreRetriever(vectorstore=db)
+        self.collection_name = index_config['name']
+        # Engine for the queries that are not supported by the langchain vectorstore
+        self.engine = sqlalchemy.create_engine(connection_string, pool_pre_ping=True)
             
     def semantic_search(self, filter: Dict, program_info: Dict, topic: str, query: str, k = 5, threshold = 0) -> List[Document]:
         """
@@ -111,25 +113,85 @@ class PGVectorRetriever(Retriever):
         - threshold: relevance threshold, all returned documents must surpass the threshold
                      relevance is cosine-similarity based, so ranges between 0 and 1
                      larger scores indicate greater relevance
+        Each returned document has its relevance in metadata['score']
         """
         self.set_top_k(k)
         query_str, kwargs = self._query_converter(filter,program_info,topic,query)
         
+        search_kwargs = {'k': k, 'filter': self.retriever.search_kwargs['filter']}
         if threshold > 0:
-            self.retriever.search_type = "similarity_score_threshold"
-            self.retriever.search_kwargs['score_threshold'] = threshold
-        else:
-            self.retriever.search_type = 'similarity'
+            search_kwargs['score_threshold'] = threshold
             
-        self._output_query_verbose(query_str, self.retriever.search_kwargs)
-        docs = self.retriever.get_relevant_documents(query_str,**kwargs)
-        return self._response_converter(docs)
+        self._output_query_verbose(query_str, search_kwargs)
+        docs_and_scores = self.retriever.vectorstore.similarity_search_with_relevance_scores(query_str, **search_kwargs, **kwargs)
+        for doc, score in docs_and_scores:
+            doc.metadata['score'] = score
+        return self._response_converter([doc for doc, _ in docs_and_scores])
+    
+    def multi_level_search(self, levels: List[Tuple[Dict,Dict]], topic: str, query: str, k = 5, threshold = 0) -> List[List[Document]]:
+        """
+        Return the documents from similarity search for each level of a backoff retrieval, in a single
+        database round trip: the KNN query of each level is tagged with the level's position,
+        and the queries are combined with UNION ALL
+        - levels: list of (filter, program_info) tuples, as passed to semantic_search
+        Other arguments are as in semantic_search
+        """
+        embeddings_model = self.retriever.vectorstore.embedding_function
+        params = {'collection_name': self.collection_name, 'k': k}
+        queries = []
+        for level, (filter, program_info) in enumerate(levels):
+            query_str, _ = self._query_converter(filter, program_info, topic, query)
+            self._output_query_verbose(query_str, {'k': k, 'filter': filter, 'level': level})
+            params[f'embedding_{level}'] = str(embeddings_model.embed_query(query_str))
+            
+            # Same metadata filter as the langchain vectorstore, an exact match of each key
+            conditions = ''
+            for i, (key, value) in enumerate(filter.items()):
+                params[f'key_{level}_{i}'] = key
+                params[f'value_{level}_{i}'] = str(value)
+                conditions += f" AND e.cmetadata->>:key_{level}_{i} = :value_{level}_{i}"
+                
+            queries.append(f"""
+                (SELECT {level} AS level, e.document, e.cmetadata, 
+                        e.embedding <=> CAST(:embedding_{level} AS vector) AS distance
+                 FROM langchain_pg_embedding e
+                 WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name){conditions}
+                 ORDER BY distance
+                 LIMIT :k)""")
+            
+        with self.engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.text(' UNION ALL '.join(queries)), params).fetchall()
+        
+        level_docs = [[] for _ in levels]
+        for row in sorted(rows, key=lambda row: (row.level, row.distance)):
+            # Cosine relevance, as the vectorstore's relevance score function
+            score = 1 - row.distance
+            if threshold > 0 and score < threshold:
+                continue
+            doc = Document(page_content=row.document, metadata=dict(row.cmetadata))
+            doc.metadata['score'] = score
+            level_docs[row.level].append(doc)
+        return [self._response_converter(docs) for docs in level_docs]
     
     def docs_from_ids(self, doc_ids: List[int]) -> List[Document]:
         """
-        Return a list of documents from a list of document indexes
+        Return a list of documents from a list of document indexes, in a single query
+        Documents are returned in the order of doc_ids, ids that are not found are skipped
         """
-        docs = self.retriever.fetch_by_id(doc_ids, self.namespace)
+        if len(doc_ids) == 0:
+            return []
+        
+        # Documents are stored with their doc_id as the custom_id
+        with self.engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.text("""
+                SELECT e.custom_id, e.document, e.cmetadata
+                FROM langchain_pg_embedding e
+                WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name)
+                    AND e.custom_id = ANY(:doc_ids)"""), 
+                {'collection_name': self.collection_name, 'doc_ids': [str(doc_id) for doc_id in doc_ids]}).fetchall()
+        
+        docs_by_id = {row.custom_id: Document(page_content=row.document, metadata=dict(row.cmetadata)) for row in rows}
+        docs = [docs_by_id[str(doc_id)] for doc_id in dict.fromkeys(doc_ids) if str(doc_id) in docs_by_id]
         return self._response_converter(docs)
     
     def set_top_k(self, k: int):
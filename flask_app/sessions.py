@@ -0,0 +1,57 @@
+"""
+Session backends of the web app
+- 'cookie': the session is stored in a cookie signed with the secret key, so checking a login needs
+            no storage access and works on any container that shares the secret key
+- 'redis': the session is stored server side in Redis (or any store that speaks the Redis protocol),
+           shared by all containers. The client can be injected, eg. a local stand-in for tests
+"""
+
+import secrets
+import logging
+from flask import Flask
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKENDS = ('cookie', 'redis')
+SESSION_KEY_PREFIX = 'advising-session:'
+
+def configure_sessions(app: Flask, backend: str = 'cookie', secret_key: str = None, redis_client = None, redis_url: str = None,
+                       dev_mode: bool = False):
+    """
+    Configure the session backend of the app
+    - backend: one of SESSION_BACKENDS
+    - secret_key: key signing the session cookies, must be the same on every container.
+                  Required unless dev_mode is set, then a random key is generated if None,
+                  so sessions only last as long as the process
+    - redis_client: client of the session store for the 'redis' backend, created from redis_url if None
+    - redis_url: url of the session store for the 'redis' backend, eg. redis://host:6379/0
+    """
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f"Unsupported session backend '{backend}', choices are {SESSION_BACKENDS}")
+
+    if not secret_key:
+        if not dev_mode:
+            raise ValueError("No session secret key configured, sessions would not be shared between containers")
+        logger.warning("No session secret key configured, generating one; sessions will not be shared between containers")
+        secret_key = secrets.token_hex(32)
+    app.secret_key = secret_key
+
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_COOKIE_HTTPONLY"] = True
+    app.config["SESSION_COOKIE_SAMESITE"] = 'Lax'
+
+    if backend == 'cookie':
+        # Flask's default session interface signs the cookie with the secret key
+        return
+
+    if redis_client is None:
+        if not redis_url:
+            raise ValueError("The 'redis' session backend needs a redis_client or redis_url")
+        import redis
+        redis_client = redis.Redis.from_url(redis_url)
+
+    from flask_session import Session
+    app.config["SESSION_TYPE"] = 'redis'
+    app.config["SESSION_REDIS"] = redis_client
+    app.config["SESSION_KEY_PREFIX"] = SESSION_KEY_PREFIX
+    Session(app)
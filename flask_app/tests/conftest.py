@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app's modules import each other from the flask_app directory, eg. 'from caches import ...'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import threading
+import pytest
+from botocore.exceptions import ClientError
+from admission import AdmissionController, TokenBucket, Overloaded
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'InvokeModel')
+
+def controller(**kwargs):
+    settings = dict(max_concurrent=1, max_queue=1, rate=1000, burst=1000, max_wait=1, backoff_base=0, backoff_cap=0)
+    settings.update(kwargs)
+    return AdmissionController(**settings)
+
+def test_bucket_rejects_a_wait_longer_than_max_wait():
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.reserve(max_wait=0) == 0
+    with pytest.raises(Overloaded) as error:
+        bucket.reserve(max_wait=0.5)
+    assert error.value.retry_after > 0.5
+    # The rejected call reserved nothing, so the next one waits no longer
+    assert 0 < bucket.reserve(max_wait=1) <= 1
+
+def test_bucket_refund_gives_back_the_token():
+    bucket = TokenBucket(rate=0.001, capacity=1)
+    bucket.reserve(max_wait=0)
+    bucket.refund()
+    assert bucket.reserve(max_wait=0) == 0
+
+def test_full_queue_rejects_calls():
+    admission = controller(max_wait=5)
+    entered = threading.Event()
+    leave = threading.Event()
+
+    def hold_slot():
+        with admission.admit():
+            entered.set()
+            leave.wait(5)
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=lambda: admission.call(lambda: None))
+    waiter.start()
+    while len(admission._waiters) == 0:
+        time.sleep(0.001)
+    with pytest.raises(Overloaded):
+        with admission.admit():
+            pass
+    leave.set()
+    holder.join()
+    waiter.join()
+    assert admission._in_use == 0 and not admission._waiters
+
+def test_calls_waiting_for_a_token_count_in_the_queue():
+    admission = controller(rate=10, burst=1)
+    admission.bucket.reserve(max_wait=0)
+    waiter = threading.Thread(target=lambda: admission.call(lambda: None))
+    waiter.start()
+    while admission._token_waiting == 0:
+        time.sleep(0.001)
+    with pytest.raises(Overloaded):
+        with admission.admit():
+            pass
+    waiter.join()
+    assert admission._token_waiting == 0
+
+def test_slot_wait_times_out_and_refunds_the_token():
+    admission = controller(max_queue=2, max_wait=0.05, rate=0.001, burst=2)
+    with admission.admit():
+        with pytest.raises(Overloaded):
+            with admission.admit():
+                pass
+    # The token of the timed out call was refunded
+    assert admission.bucket.reserve(max_wait=0) == 0
+
+def test_async_calls_are_limited_to_max_concurrent():
+    admission = controller(max_concurrent=2, max_queue=10, max_wait=5)
+    running = 0
+    peak = 0
+
+    async def model_call():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        await asyncio.gather(*(admission.call_async(model_call) for _ in range(8)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert admission._in_use == 0
+
+def test_throttled_calls_are_retried_then_rejected():
+    admission = controller(max_retries=2)
+    attempts = []
+
+    def throttled():
+        attempts.append(1)
+        raise throttling_error()
+
+    with pytest.raises(Overloaded):
+        admission.call(throttled)
+    assert len(attempts) == 3
+
+def test_other_errors_are_not_retried():
+    admission = controller()
+    with pytest.raises(ValueError):
+        admission.call(lambda: (_ for _ in ()).throw(ValueError("bad input")))
+    assert admission._in_use == 0
@@ -0,0 +1,69 @@
+import numpy as np
+from caches import EmbeddingCache
+
+DIMENSION = 4
+
+def vector(value: float):
+    return [value] * DIMENSION
+
+def colliding_keys(disk_slots: int):
+    """
+    Two keys of different texts that hash to the same slot of the file
+    """
+    first = EmbeddingCache.make_key("question 0", 'model', DIMENSION)
+    for idx in range(1, 100000):
+        key = EmbeddingCache.make_key(f"question {idx}", 'model', DIMENSION)
+        if key % disk_slots == first % disk_slots:
+            return first, key
+    raise AssertionError("No colliding keys found")
+
+def test_memory_entries_are_evicted_least_recently_used_first():
+    cache = EmbeddingCache(DIMENSION, max_size=2)
+    cache.put(1, vector(1))
+    cache.put(2, vector(2))
+    assert cache.get(1) == vector(1)
+    cache.put(3, vector(3))
+    assert cache.get(2) is None
+    assert cache.get(1) == vector(1)
+    assert cache.get(3) == vector(3)
+
+def test_persisted_entries_are_shared(tmp_path):
+    path = str(tmp_path / 'embeddings.npy')
+    EmbeddingCache(DIMENSION, path=path, disk_slots=16).put(5, vector(0.5))
+    assert EmbeddingCache(DIMENSION, path=path, disk_slots=16).get(5) == vector(0.5)
+
+def test_colliding_key_replaces_the_slot(tmp_path):
+    path = str(tmp_path / 'embeddings.npy')
+    first, second = colliding_keys(16)
+    writer = EmbeddingCache(DIMENSION, path=path, disk_slots=16)
+    writer.put(first, vector(1))
+    writer.put(second, vector(2))
+
+    reader = EmbeddingCache(DIMENSION, path=path, disk_slots=16)
+    assert reader.get(first) is None
+    assert reader.get(second) == vector(2)
+
+def test_torn_vector_is_a_miss(tmp_path):
+    path = str(tmp_path / 'embeddings.npy')
+    cache = EmbeddingCache(DIMENSION, path=path, disk_slots=16)
+    cache.put(7, vector(1))
+    # Another writer changed the vector, but not the checksum
+    disk = np.load(path, mmap_mode='r+')
+    disk['vector'][7 % 16][0] = 2
+    disk.flush()
+    assert EmbeddingCache(DIMENSION, path=path, disk_slots=16).get(7) is None
+
+def test_file_with_a_different_layout_is_recreated(tmp_path):
+    path = str(tmp_path / 'embeddings.npy')
+    EmbeddingCache(DIMENSION, path=path, disk_slots=16).put(3, vector(1))
+    cache = EmbeddingCache(DIMENSION + 1, path=path, disk_slots=16)
+    assert cache.get(3) is None
+    assert np.load(path, mmap_mode='r').dtype['vector'].shape == (DIMENSION + 1,)
+
+def test_clear_removes_persisted_entries(tmp_path):
+    path = str(tmp_path / 'embeddings.npy')
+    cache = EmbeddingCache(DIMENSION, path=path, disk_slots=16)
+    cache.put(9, vector(1))
+    cache.clear()
+    assert cache.get(9) is None
+    assert EmbeddingCache(DIMENSION, path=path, disk_slots=16).get(9) is None
@@ -0,0 +1,32 @@
+from highlighter import AhoCorasick, highlight_compressed_sections, merge_spans
+
+def test_longest_match_ending_at_each_position():
+    matches = list(AhoCorasick(["he", "she", "hers"]).longest_matches("ushers"))
+    assert matches == [(1, 4), (2, 6)]
+
+def test_overlapping_and_nested_spans_are_merged():
+    assert merge_spans([(0, 5), (4, 6), (3, 8), (10, 12)]) == [(0, 8), (10, 12)]
+    assert merge_spans([(5, 6), (0, 10)]) == [(0, 10)]
+
+def test_adjacent_spans_are_kept_apart():
+    assert merge_spans([(0, 5), (5, 8)]) == [(0, 5), (5, 8)]
+
+def test_overlapping_sentences_are_highlighted_once():
+    original = "Students must complete alpha beta gamma delta before graduating."
+    compressed = "1. alpha beta gamma\n2. \"beta gamma delta\""
+    assert highlight_compressed_sections(original, compressed) == \
+        "Students must complete *alpha beta gamma delta* before graduating."
+
+def test_sentences_match_across_changed_whitespace():
+    original = "First line of the\n  requirement.\nUnrelated text."
+    highlighted = highlight_compressed_sections(original, "line of the requirement.")
+    assert highlighted == "First *line of the*\n  *requirement*.\nUnrelated text."
+
+def test_regex_characters_are_matched_as_text():
+    original = "Take MATH 100 (or 180) [3 credits]."
+    assert highlight_compressed_sections(original, "(or 180) [3 credits]") == "Take MATH 100 (*or 180) [3 credits*]."
+
+def test_no_matches_leaves_the_text_unchanged():
+    original = "Nothing relevant here."
+    assert highlight_compressed_sections(original, "a sentence from another document") == original
+    assert highlight_compressed_sections(original, "") == original
@@ -0,0 +1,61 @@
+import pytest
+from relevance_trailer import TrailerFilter, parse_judgments, split_relevance_trailer
+
+ANSWER = "You can take CPSC 110.\nIt is offered every term."
+TRAILER = "RELEVANCE:\nDocument 1: Lists the course.\nDocument 2: Not relevant,\nit is about another faculty."
+
+def stream(text: str, size: int):
+    """
+    Feed the text to a TrailerFilter in chunks of size characters, returning the shown text and the filter
+    """
+    trailer_filter = TrailerFilter()
+    shown = ''.join(trailer_filter.feed(text[i:i + size]) for i in range(0, len(text), size))
+    return shown + trailer_filter.remainder(), trailer_filter
+
+def test_trailer_is_split_from_the_answer():
+    answer, judgments = split_relevance_trailer(ANSWER + "\n\n" + TRAILER)
+    assert answer == ANSWER
+    assert judgments == {1: "Lists the course.", 2: "Not relevant, it is about another faculty."}
+
+@pytest.mark.parametrize('marker', ["**RELEVANCE:**", "### RELEVANCE:", "RELEVANCE :", "> RELEVANCE:"])
+def test_decorated_marker(marker):
+    answer, judgments = split_relevance_trailer(f"{ANSWER}\n{marker}\n- **Document 1**: Lists the course.")
+    assert answer == ANSWER
+    assert judgments == {1: "Lists the course."}
+
+def test_bracketed_judgments():
+    assert parse_judgments("[1] Lists the course.\n[3]: Not relevant.") == {1: "Lists the course.", 3: "Not relevant."}
+
+@pytest.mark.parametrize('text', [
+    ANSWER,
+    ANSWER + "\nRelevance\nThis is about the relevance of courses.",
+    ANSWER + "\nRELEVANCE: of the prerequisites is explained below.",
+    ANSWER + "\nRELEVANCE:\nThe prerequisites are listed in the calendar.",
+    ANSWER + "\nRELEVANCE:\nDocument 1:",
+])
+def test_text_without_a_trailer_is_the_answer(text):
+    assert split_relevance_trailer(text) == (text.strip(), {})
+
+def test_last_marker_with_judgments_is_the_trailer():
+    text = "RELEVANCE:\nThe marker is in the answer.\n" + TRAILER
+    answer, judgments = split_relevance_trailer(text)
+    assert answer == "RELEVANCE:\nThe marker is in the answer."
+    assert set(judgments) == {1, 2}
+
+@pytest.mark.parametrize('size', [1, 3, 7, 1000])
+def test_filter_hides_the_trailer(size):
+    shown, trailer_filter = stream(ANSWER + "\n\n" + TRAILER, size)
+    assert shown.strip() == ANSWER
+    assert trailer_filter.finish()[1][1] == "Lists the course."
+
+@pytest.mark.parametrize('size', [1, 4, 1000])
+def test_filter_shows_a_marker_without_judgments(size):
+    text = ANSWER + "\nRELEVANCE:\n\nThe prerequisites are listed in the calendar."
+    shown, trailer_filter = stream(text, size)
+    assert shown == text
+    assert trailer_filter.finish() == (text, {})
+
+def test_filter_shows_a_partial_marker_once_the_line_differs():
+    trailer_filter = TrailerFilter()
+    assert trailer_filter.feed("REL") == ''
+    assert trailer_filter.feed("EASE notes") == "RELEASE notes"
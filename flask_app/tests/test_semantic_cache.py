@@ -0,0 +1,52 @@
+import re
+import zlib
+import numpy as np
+from caches import SemanticCache
+
+DIMENSION = 256
+PARTITION = SemanticCache.make_partition('Faculty of Science : Computer Science : Third Year', 'model', 'default', 1, 3)
+# Prefix that format_question adds for the program context of PARTITION
+CONTEXT_PREFIX = ("I am in Faculty of Science. I am in the Computer Science program. "
+                  "I am in my Third Year. The topic of the question is Degree Requirements. ")
+
+def embed(text: str) -> np.ndarray:
+    """
+    Bag of words embedding, so texts sharing most of their words are close like with a real embedding model
+    """
+    vector = np.zeros(DIMENSION, dtype=np.float32)
+    for word in re.findall(r'\w+', text.lower()):
+        vector[zlib.crc32(word.encode()) % DIMENSION] += 1
+    return vector
+
+def test_same_question_hits():
+    cache = SemanticCache(DIMENSION, max_size=8)
+    cache.put(embed("How many credits do I need to graduate?"), PARTITION, {"answer": "120"})
+    assert cache.get(embed("how many credits do i need to graduate"), PARTITION) == {"answer": "120"}
+
+def test_different_questions_with_the_same_context_do_not_collide():
+    first = "How many credits do I need to graduate?"
+    second = "Can I take a course twice?"
+
+    # Matched with the program context prepended, the shared context makes the questions collide
+    cache = SemanticCache(DIMENSION, max_size=8, max_distance=0.08)
+    cache.put(embed(CONTEXT_PREFIX + first), PARTITION, {"answer": "120"})
+    assert cache.get(embed(CONTEXT_PREFIX + second), PARTITION) == {"answer": "120"}
+
+    # The bare questions are matched instead, the context is part of the partition
+    cache = SemanticCache(DIMENSION, max_size=8, max_distance=0.08)
+    cache.put(embed(first), PARTITION, {"answer": "120"})
+    assert cache.get(embed(second), PARTITION) is None
+
+def test_partitions_are_separate():
+    cache = SemanticCache(DIMENSION, max_size=8)
+    other = SemanticCache.make_partition('Faculty of Arts', 'model', 'default', 1, 3)
+    cache.put(embed("How many credits do I need to graduate?"), PARTITION, {"answer": "120"})
+    assert cache.get(embed("How many credits do I need to graduate?"), other) is None
+
+def test_oldest_entries_are_replaced():
+    cache = SemanticCache(DIMENSION, max_size=2)
+    questions = ["How many credits do I need?", "When is the add drop deadline?", "Who is my advisor?"]
+    for idx, question in enumerate(questions):
+        cache.put(embed(question), PARTITION, {"answer": idx})
+    assert cache.get(embed(questions[0]), PARTITION) is None
+    assert cache.get(embed(questions[2]), PARTITION) == {"answer": 2}
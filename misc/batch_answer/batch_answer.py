@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import sys
+import requests
+
+"""
+Script to answer a file of questions with the /answer/batch endpoint of the web app,
+eg. to replay a question set for evaluation.
+
+The input file has one question per line, either as plain text or as a json object
+with a 'question' and optionally the 'topic', 'faculty', 'program', 'specialization' and 'year' fields.
+Results are written as json lines, in the order questions are answered; each line
+has the 'index' of its question in the input file.
+
+Requires that the USERNAME and PASSWORD environment variables are set to the web app's login.
+
+Usage:
+python batch_answer.py --url https://<app-url> --input questions.jsonl --output answers.jsonl --parallelism 8
+"""
+
+### ARG CONFIG
+parser = argparse.ArgumentParser()
+parser.add_argument('--url',required=True,help="Base url of the web app")
+parser.add_argument('--input',required=True,help="File of questions, one per line")
+parser.add_argument('--output',default=None,help="File to write the json line results to, defaults to stdout")
+parser.add_argument('--parallelism',type=int,default=8,help="Number of questions the app answers concurrently")
+parser.add_argument('--batch_size',type=int,default=200,help="Number of questions sent per request")
+parser.add_argument('--number_of_docs',type=int,default=3,help="Number of documents to retrieve per question")
+
+def read_questions(path: str) -> list:
+    """
+    Read the questions from the input file
+    """
+    questions = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                entry = line
+            if isinstance(entry, str):
+                entry = {'question': entry}
+            questions.append(entry)
+    return questions
+
+def login(session: requests.Session, url: str):
+    """
+    Log in to the web app, the session keeps the login cookie
+    """
+    response = session.post(f"{url}/login", data={'username': os.environ["USERNAME"], 'password': os.environ["PASSWORD"]})
+    response.raise_for_status()
+    if 'Invalid Credentials' in response.text:
+        raise Exception("Could not log in to the web app, check the USERNAME and PASSWORD environment variables")
+
+def answer_batch(session: requests.Session, url: str, questions: list, offset: int, out, args):
+    """
+    Send one batch of questions and write the results as they arrive
+    - offset: index of the first question of the batch in the input file
+    """
+    body = {'questions': questions, 'parallelism': args.parallelism, 'number_of_docs': args.number_of_docs}
+    with session.post(f"{url}/answer/batch", json=body, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line: continue
+            result = json.loads(line)
+            result['index'] += offset
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            print(f"Answered question {result['index']}{' (error)' if 'error' in result else ''}", file=sys.stderr)
+
+def main():
+    args = parser.parse_args()
+    url = args.url.rstrip('/')
+    questions = read_questions(args.input)
+
+    session = requests.Session()
+    login(session, url)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for offset in range(0, len(questions), args.batch_size):
+            answer_batch(session, url, questions[offset:offset + args.batch_size], offset, out, args)
+    finally:
+        if args.output: out.close()
+
+if __name__ == "__main__":
+    main()